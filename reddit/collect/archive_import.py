@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+#
+# Import comments or submissions from monthly archive dumps.
+#
+# Historical reddit data is distributed as zstd-compressed newline-delimited
+# JSON, one file a month (RC_2017-01.zst holds comments, RS_2017-01.zst
+# submissions). Dumps are decompressed as a stream, so files are never
+# inflated on disk or in memory, and cut into chunks of lines that a pool of
+# processes parses and filters by subreddit, author and date. Matching
+# records are bulk written through COPY into the same tables the collectors
+# write: comments to the table of their subreddit, submissions to
+# reddit_submissions.
+#
+# Uncompressed .ndjson/.json files are read as well, which makes it easy to
+# try the importer on small locally made files.
+#
+# Requires zstandard for .zst dumps.
+#   $ pip install zstandard
+#
+
+import argparse
+import collections
+import concurrent.futures
+import configparser
+import datetime
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+import psycopg2
+
+import bulk_writer
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('main')
+
+working_dir = os.path.realpath(__file__)
+working_dir = os.path.dirname(working_dir)
+
+# Dumps are compressed with long distance matching and a window of up to 2GB
+ZSTD_WINDOW = 2 ** 31
+
+# Record kind implied by a dump's file name prefix
+FILE_PREFIXES = {'RC_': 'comments', 'RS_': 'submissions'}
+
+def _connect_to_db(dh_host, db_name, db_user, db_user_pass):
+    conn = None
+    cursor = None
+
+    connstr = \
+            "host={db_host} " + \
+            "dbname='{db_name}' " + \
+            "user='{db_user}' " + \
+            "password='{db_user_pass}'"
+    connstr = connstr.format(
+                db_host=db_host,
+                db_name=db_name,
+                db_user=db_user,
+                db_user_pass=db_user_pass)
+    try:
+        conn = psycopg2.connect(connstr)
+
+    except Exception as e:
+        logger.exception(e)
+
+    return conn
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Import comments or submissions from archive dumps.')
+
+    parser.add_argument('files', action='store', nargs='+',
+            help='dump files, .zst or uncompressed')
+    parser.add_argument('-k', '--kind', action='store',
+            choices=['comments', 'submissions'],
+            help='record kind; by default taken from the RC_/RS_ file prefix')
+    parser.add_argument('-s', '--subreddit', action='store', nargs='+',
+            help='only import these subreddits')
+    parser.add_argument('-a', '--author', action='store', nargs='+',
+            help='only import posts by these redditors')
+    parser.add_argument('-r', '--daterange', nargs=2, action='store',
+            help='only import posts within start and end formatted yyyymmddhhmmss')
+    parser.add_argument('-t', '--table', action='store',
+            default='{subreddit}',
+            help='comment table; {subreddit} is replaced per subreddit')
+    parser.add_argument('-u', '--unsafe', action='store_true',
+            help='skip deduplication and COPY straight into the destination tables')
+    parser.add_argument('-w', '--workers', action='store', type=int,
+            default=os.cpu_count() or 1,
+            help='number of processes parsing records')
+    parser.add_argument('--chunk-lines', action='store', type=int,
+            default=20000, help='lines handed to a worker at a time')
+    parser.add_argument('--batch-rows', action='store', type=int,
+            default=50000, help='commit after this many rows')
+    parser.add_argument('-d', '--debug', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.daterange is not None:
+        args.daterange = sorted(args.daterange)
+        args.daterange = [datetime.datetime.strptime(d, '%Y%m%d%H%M%S')
+                for d in args.daterange]
+
+    for path in args.files:
+        if _file_kind(path, args.kind) is None:
+            parser.error('can\'t tell whether {} holds comments or submissions; '
+                    'pass --kind'.format(path))
+        if _file_kind(path, args.kind) == 'comments' and \
+                args.subreddit is None and '{subreddit}' in args.table:
+            parser.error('comments are written to a table per subreddit; pass '
+                    '--subreddit or a --table without {subreddit}')
+
+    return args
+
+def parse_config():
+    config = configparser.ConfigParser()
+    config.read_file(open(os.path.join(working_dir, '../config.conf')))
+    return config
+
+def _file_kind(path, kind=None):
+    if kind is not None:
+        return kind
+    name = os.path.basename(path)
+    for prefix, kind in FILE_PREFIXES.items():
+        if name.startswith(prefix):
+            return kind
+    return None
+
+def _open_dump(path):
+    """Open a dump as a text stream, decompressing as it's read.
+
+    Returns the text stream and the underlying file, whose position tracks
+    progress through the compressed data.
+    """
+    fh = open(path, 'rb')
+    if path.endswith('.zst'):
+        import zstandard
+        reader = zstandard.ZstdDecompressor(
+                max_window_size=ZSTD_WINDOW).stream_reader(fh)
+    else:
+        reader = fh
+    return io.TextIOWrapper(reader, encoding='utf-8', errors='replace'), fh
+
+def _read_chunks(stream, chunk_lines):
+    """Yield lists of up to chunk_lines lines."""
+    chunk = list()
+    for line in stream:
+        chunk.append(line)
+        if len(chunk) >= chunk_lines:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+def _timestamp(value):
+    """Dumps hold epochs as ints, floats or strings, depending on the year."""
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(float(value))
+
+def _text(value):
+    if value is None:
+        return None
+    return str(value).replace('\x00', '')
+
+def _comment_record(post):
+    return {
+            'id': post['id'],
+            'parent_id': post.get('parent_id'),
+            'link_id': post.get('link_id'),
+            'author': _text(post.get('author')),
+            'created': _timestamp(post.get('created', post.get('created_utc'))),
+            'created_utc': _timestamp(post.get('created_utc')),
+            'author_flair_text': post.get('author_flair_text'),
+            'author_flair_css': post.get('author_flair_css_class'),
+            'edited': bool(post.get('edited')),
+            'body': _text(post.get('body'))
+    }
+
+def _submission_record(post):
+    return {
+            'id': post['id'],
+            'subreddit': post.get('subreddit'),
+            'author': _text(post.get('author')),
+            'author_flair_text': post.get('author_flair_text'),
+            'author_flair_css': post.get('author_flair_css_class'),
+            'created': _timestamp(post.get('created', post.get('created_utc'))),
+            'created_utc': _timestamp(post.get('created_utc')),
+            'domain': post.get('domain'),
+            'downs': post.get('downs'),
+            'ups': post.get('ups'),
+            'score': post.get('score'),
+            'num_comments': post.get('num_comments'),
+            'name': post.get('name') or 't3_' + post['id'],
+            'permalink': post.get('permalink'),
+            'url': post.get('url'),
+            'selftext': _text(post.get('selftext')),
+            'title': _text(post.get('title'))
+    }
+
+RECORDS = {'comments': _comment_record, 'submissions': _submission_record}
+
+# Set in each worker process by _init_worker
+filters = None
+
+def _init_worker(worker_filters):
+    global filters
+    filters = worker_filters
+
+def _parse_chunk(kind, lines):
+    """Parse and filter a chunk of dump lines in a worker process.
+
+    Returns (records, n_malformed); records are (subreddit, record) tuples
+    with the subreddit in lower case.
+    """
+    subreddits, authors, start, end = filters
+    make_record = RECORDS[kind]
+    records = list()
+    n_malformed = 0
+    for line in lines:
+        try:
+            post = json.loads(line)
+            subreddit = (post.get('subreddit') or '').lower()
+            if subreddits is not None and subreddit not in subreddits:
+                continue
+            if authors is not None and \
+                    (post.get('author') or '').lower() not in authors:
+                continue
+            record = make_record(post)
+            if start is not None and not start <= record['created_utc'] <= end:
+                continue
+        except (ValueError, KeyError, TypeError):
+            n_malformed += 1
+            continue
+        records.append((subreddit, record))
+    return records, n_malformed
+
+class Importer(object):
+    """Write parsed records, committing every batch_rows rows.
+
+    Arguments:
+        tables      - dictionary mapping lower case subreddit names to
+                      comment tables, or a single table for every comment
+        unsafe      - COPY straight into the destination tables
+        batch_rows  - rows written between commits
+    """
+
+    def __init__(self, tables, unsafe=False, batch_rows=50000):
+        self.tables = tables
+        self.unsafe = unsafe
+        self.batch_rows = batch_rows
+        self.pending = collections.defaultdict(list)
+        self.n_pending = 0
+        self.counts = [0, 0, 0]
+
+    def _table(self, kind, subreddit):
+        if kind == 'submissions':
+            return 'reddit_submissions'
+        if isinstance(self.tables, dict):
+            return self.tables[subreddit]
+        return self.tables
+
+    def add(self, kind, records):
+        for subreddit, record in records:
+            self.pending[(kind, self._table(kind, subreddit))].append(record)
+        self.n_pending += len(records)
+        if self.n_pending >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """Write and commit every pending row in one transaction."""
+        for (kind, table), rows in self.pending.items():
+            columns = bulk_writer.COMMENT_COLUMNS if kind == 'comments' \
+                    else bulk_writer.SUBMISSION_COLUMNS
+            for n, count in enumerate(bulk_writer.write_rows(
+                    conn, table, columns, rows, not self.unsafe, commit=False)):
+                self.counts[n] += count
+        conn.commit()
+        self.pending = collections.defaultdict(list)
+        self.n_pending = 0
+
+def import_dump(path, kind, importer, executor, workers, chunk_lines):
+    """Stream one dump through the worker pool into the importer.
+
+    At most twice as many chunks as there are workers are in flight, so
+    reading never runs far ahead of parsing and memory stays flat.
+    """
+    stream, fh = _open_dump(path)
+    size = max(os.path.getsize(path), 1)
+    started = time.time()
+    n_lines = 0
+    n_matched = 0
+    n_malformed = 0
+    in_flight = collections.deque()
+
+    def collect(future):
+        records, malformed = future.result()
+        importer.add(kind, records)
+        return len(records), malformed
+
+    try:
+        for chunk in _read_chunks(stream, chunk_lines):
+            in_flight.append(executor.submit(_parse_chunk, kind, chunk))
+            n_lines += len(chunk)
+            if len(in_flight) >= workers * 2:
+                matched, malformed = collect(in_flight.popleft())
+                n_matched += matched
+                n_malformed += malformed
+
+                elapsed = max(time.time() - started, 0.001)
+                sys.stdout.write('\r{} {:5.1f}% | {} lines, {} matched | {:.0f} lines/s'.format(
+                        os.path.basename(path), fh.tell() / size * 100,
+                        n_lines, n_matched, n_lines / elapsed))
+                sys.stdout.flush()
+        while len(in_flight) > 0:
+            matched, malformed = collect(in_flight.popleft())
+            n_matched += matched
+            n_malformed += malformed
+        importer.flush()
+
+    finally:
+        for future in in_flight:
+            future.cancel()
+        stream.close()
+
+    elapsed = max(time.time() - started, 0.001)
+    sys.stdout.write('\n')
+    logger.info('{}: {} lines, {} matched, {} malformed in {:.0f}s ({:.0f} lines/s)'.format(
+            path, n_lines, n_matched, n_malformed, elapsed, n_lines / elapsed))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    config = parse_config()
+
+    if args.debug:
+        logger.level = logging.DEBUG
+
+    db_host = config['DEFAULT']['db_host']
+    db_name = config['DEFAULT']['db_name']
+    db_user = config['DEFAULT']['db_user']
+    db_pass = config['DEFAULT']['db_pass']
+
+    subreddits = None
+    tables = args.table
+    if args.subreddit is not None:
+        subreddits = set(name.lower() for name in args.subreddit)
+        tables = dict()
+        for name in args.subreddit:
+            tables[name.lower()] = args.table.format(subreddit=name)
+    authors = None
+    if args.author is not None:
+        authors = set(name.lower() for name in args.author)
+    start, end = args.daterange or (None, None)
+
+    global conn
+    conn = None
+    executor = None
+    try:
+        logger.debug('connect to database')
+        conn = _connect_to_db(db_host, db_name, db_user, db_pass)
+        if conn is None:
+            sys.exit(1)
+
+        executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.workers,
+                initializer=_init_worker,
+                initargs=((subreddits, authors, start, end),))
+        importer = Importer(tables, args.unsafe, args.batch_rows)
+        for path in args.files:
+            import_dump(path, _file_kind(path, args.kind), importer, executor,
+                    args.workers, args.chunk_lines)
+
+        logger.info('{} rows written, {} skipped, {} failed'.format(
+                *importer.counts))
+
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('exiting')
+
+    except Exception as e:
+        logger.exception(e)
+
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+        if not conn is None:
+            conn.close()
+
+    sys.exit(0)
@@ -0,0 +1,488 @@
+#
+# asyncio collection engine.
+#
+# Runs stream listings, backfill fetches and database writes concurrently on a
+# single event loop with asyncpraw and asyncpg. This backs the --async mode of
+# subreddit_stream.py and subreddit_comments.py; records, table routing,
+# deduplication and checkpoints are the same as the threaded collectors, and
+# batches are merged through a staging table with bulk_writer.merge_sql.
+#
+# Requires asyncpraw and asyncpg, which the threaded collectors don't need, so
+# the scripts only import this module when --async is given.
+#
+
+import asyncio
+import datetime
+import json
+import logging
+import sys
+
+import asyncpg
+import asyncpraw
+import asyncprawcore
+
+import bulk_writer
+import harvest
+import scheduler
+
+logger = logging.getLogger('main')
+
+# Subreddits combined into a single a+b+c stream listing
+LISTING_SIZE = 50
+
+def instantiate_reddit(config):
+    return asyncpraw.Reddit(
+            client_id = config['DEFAULT']['reddit_client_id'],
+            client_secret = config['DEFAULT']['reddit_client_secret'],
+            user_agent = config['DEFAULT']['reddit_user_agent'])
+
+async def connect_pool(config, size=4):
+    return await asyncpg.create_pool(
+            host = config['DEFAULT']['db_host'],
+            database = config['DEFAULT']['db_name'],
+            user = config['DEFAULT']['db_user'],
+            password = config['DEFAULT']['db_pass'],
+            min_size = 1,
+            max_size = size)
+
+def is_retryable(e):
+    """Whether an exception from asyncpraw is worth retrying after a backoff."""
+    if isinstance(e, asyncprawcore.exceptions.RequestException):
+        return True
+    status = getattr(getattr(e, 'response', None), 'status', None)
+    return status is not None and (status == 429 or status >= 500)
+
+class AsyncRateBudget(scheduler.RateBudget):
+    """A RateBudget whose waits yield to the event loop instead of blocking."""
+
+    async def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def backoff(self, attempt):
+        delay = self._backoff_delay(attempt)
+        await asyncio.sleep(delay)
+        return delay
+
+    async def call(self, reddit, function, *args, **kwargs):
+        """Await an API request paced by the budget, retrying on failure."""
+        attempt = 0
+        while True:
+            await self.acquire()
+            try:
+                result = await function(*args, **kwargs)
+                self.update(reddit)
+                return result
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                delay = await self.backoff(attempt)
+                logger.warning('{}; retry {} of {} after {:.1f}s'.format(
+                        e, attempt, self.max_retries, delay))
+
+async def _copy_rows(conn, table, columns, rows):
+    """COPY rows into table, splitting the batch to isolate rejected rows.
+
+    Returns a list of (row, error) tuples for rows that could not be copied.
+    """
+    if len(rows) == 0:
+        return list()
+
+    try:
+        # A nested transaction is a savepoint
+        async with conn.transaction():
+            await conn.copy_records_to_table(
+                    table,
+                    records=[tuple(row.get(c) for c in columns) for row in rows],
+                    columns=list(columns))
+        return list()
+    except Exception as e:
+        if len(rows) == 1:
+            return [(rows[0], str(e).strip())]
+
+    middle = len(rows) // 2
+    return await _copy_rows(conn, table, columns, rows[:middle]) + \
+            await _copy_rows(conn, table, columns, rows[middle:])
+
+async def _quarantine(conn, table, rejected):
+    sql = '''
+        INSERT INTO {quarantine} (table_name, id, record, error)
+        VALUES ($1, $2, $3, $4);
+    '''.format(quarantine=bulk_writer.QUARANTINE_TABLE)
+    for row, error in rejected:
+        logger.error('quarantined {} row {}: {}'.format(table, row.get('id'), error))
+        try:
+            async with conn.transaction():
+                await conn.execute(sql, table, row.get('id'),
+                        json.dumps(row, default=str), error)
+        except Exception as e:
+            logger.exception(e)
+            logger.error(row)
+
+async def write_rows(conn, table, columns, rows, dedupe=True):
+    """Bulk write a batch of rows within the caller's transaction.
+
+    The asyncpg counterpart of bulk_writer.write_rows.
+
+    Returns inserted_rows, skipped_rows, failed_rows
+
+    Note:
+    This function is NOT AT ALL SAFE for public use.
+    """
+    # Unquoted names fold to lower case, which asyncpg's quoted COPY won't do
+    if not dedupe:
+        rejected = await _copy_rows(conn, table.lower(), columns, rows)
+        await _quarantine(conn, table, rejected)
+        return len(rows) - len(rejected), 0, len(rejected)
+
+    staging = bulk_writer.staging_table(table).lower()
+    await conn.execute('''
+        CREATE TEMPORARY TABLE IF NOT EXISTS {staging}
+            (LIKE {table} INCLUDING DEFAULTS)
+            ON COMMIT DELETE ROWS;
+    '''.format(staging=staging, table=table))
+    rejected = await _copy_rows(conn, staging, columns, rows)
+    await _quarantine(conn, table, rejected)
+
+    status = await conn.execute(bulk_writer.merge_sql(table, staging, columns))
+    inserted_rows = int(status.split()[-1])
+    return inserted_rows, len(rows) - len(rejected) - inserted_rows, len(rejected)
+
+def _disconnected(conn, error):
+    """Whether error means the connection, not the rows, is at fault."""
+    return isinstance(error, (asyncpg.InterfaceError,
+            asyncpg.exceptions.ConnectionFailureError)) or conn.is_closed()
+
+async def _mark_completed(conn, job, ids):
+    """The asyncpg counterpart of checkpoint.mark_completed."""
+    if job is None or len(ids) == 0:
+        return
+    await conn.execute('''
+        UPDATE reddit_checkpoint_submissions
+        SET completed = true
+        WHERE subreddit = $1 AND start_date = $2 AND end_date = $3
+            AND submission_id = ANY($4::varchar[]);
+    ''', job[0], job[1], job[2], list(ids))
+
+class AsyncBatchWriter(object):
+    """Group-commit rows from many coroutines.
+
+    Rows wait on a bounded queue, so producers are held back when the
+    database falls behind. They're flushed every batch_rows rows or batch_ms
+    milliseconds; each flush writes every table it holds, and marks any
+    checkpointed submissions completed, in one transaction. Each table is
+    written under its own savepoint: one that can't be written for any reason
+    but a lost connection, such as one never created, has its rows
+    quarantined and the rest of the flush commits. Up to the pool's
+    size flushes run at once, except for a checkpointed job: its flushes run
+    one after another, so a submission is never marked completed before the
+    flush holding its rows has committed, and submissions with rows in a
+    flush that failed are never marked completed at all.
+
+    Arguments:
+        pool        - asyncpg pool
+        batch_rows  - rows per flush
+        batch_ms    - longest time in milliseconds a row waits for a flush
+        queue_size  - rows held between producers and the writer
+        dedupe      - merge through a staging table; see write_rows
+        job         - checkpointed (subreddit, start, end) of a backfill
+    """
+
+    def __init__(self, pool, batch_rows=500, batch_ms=1000, queue_size=20000,
+            dedupe=True, job=None):
+        self.pool = pool
+        self.batch_rows = batch_rows
+        self.batch_ms = batch_ms
+        self.dedupe = dedupe
+        self.job = job
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._flushes = asyncio.Semaphore(
+                1 if job is not None else pool.get_max_size())
+        self._lost = set()
+        self._tasks = set()
+        self._runner = None
+        self.commits = 0
+        self.rows = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.commit_seconds = 0.0
+
+    def start(self):
+        self._runner = asyncio.ensure_future(self._run())
+
+    async def add(self, table, columns, row):
+        await self.queue.put(('row', (table, tuple(columns)), row))
+
+    async def done(self, s_id):
+        """Queue a checkpointed submission whose rows are all queued."""
+        await self.queue.put(('done', None, s_id))
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        pending = dict()
+        completed = list()
+        n_pending = 0
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - loop.time(), 0)
+            try:
+                kind, key, item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                kind = None
+
+            if kind == 'row':
+                pending.setdefault(key, list()).append(item)
+                n_pending += 1
+                if deadline is None:
+                    deadline = loop.time() + self.batch_ms / 1000.0
+            elif kind == 'done':
+                completed.append(item)
+                if deadline is None:
+                    deadline = loop.time() + self.batch_ms / 1000.0
+
+            if kind == 'close' or n_pending >= self.batch_rows or \
+                    (deadline is not None and loop.time() >= deadline):
+                if n_pending > 0 or len(completed) > 0:
+                    await self._flushes.acquire()
+                    task = asyncio.ensure_future(
+                            self._flush(pending, n_pending, completed))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                pending = dict()
+                completed = list()
+                n_pending = 0
+                deadline = None
+            if kind == 'close':
+                return
+
+    async def _flush(self, pending, n_pending, completed):
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        completed = [s_id for s_id in completed if s_id not in self._lost]
+        try:
+            counts = [0, 0, 0]
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    for (table, columns), rows in pending.items():
+                        try:
+                            # A nested transaction is a savepoint
+                            async with conn.transaction():
+                                table_counts = await write_rows(
+                                        conn, table, columns, rows, self.dedupe)
+                        except Exception as e:
+                            if _disconnected(conn, e):
+                                raise
+                            logger.error('could not write {} rows to {}: {}'.format(
+                                    len(rows), table, str(e).strip()))
+                            await _quarantine(conn, table,
+                                    [(row, str(e).strip()) for row in rows])
+                            table_counts = (0, 0, len(rows))
+                        for n, count in enumerate(table_counts):
+                            counts[n] += count
+                    await _mark_completed(conn, self.job, completed)
+        except Exception as e:
+            logger.exception(e)
+            logger.error('lost a batch of {} rows'.format(n_pending))
+            self.failed += n_pending
+            if self.job is not None:
+                for rows in pending.values():
+                    self._lost.update(row['link_id'][3:] for row in rows)
+            return
+        finally:
+            self._flushes.release()
+
+        self.commit_seconds += loop.time() - started
+        self.commits += 1
+        self.rows += n_pending
+        self.inserted += counts[0]
+        self.skipped += counts[1]
+        self.failed += counts[2]
+
+    async def close(self):
+        """Flush what's queued and wait for every flush to finish."""
+        await self.queue.put(('close', None, None))
+        await self._runner
+        if len(self._tasks) > 0:
+            await asyncio.wait(list(self._tasks))
+        logger.info('{} rows in {} commits; {} written, {} skipped, {} failed'.format(
+                self.rows, self.commits, self.inserted, self.skipped, self.failed))
+        if len(self._lost) > 0:
+            logger.warning('{} submissions not written; rerun to retry them'.format(
+                    len(self._lost)))
+
+    def describe(self):
+        if self.commits == 0:
+            return 'no commits yet'
+        return '{:.1f} rows/commit, {:.0f} ms/commit'.format(
+                float(self.rows) / self.commits,
+                self.commit_seconds / self.commits * 1000)
+
+async def _stream_listing(reddit, names, tables, ids, budget, writer, counts):
+    """Follow one combined listing, restarting it after failures."""
+    attempt = 0
+    while True:
+        try:
+            subreddit = await reddit.subreddit('+'.join(names))
+            async for comment in subreddit.stream.comments(pause_after=-1):
+                attempt = 0
+                budget.update(reddit)
+                if comment is None:
+                    continue
+                if not ids.add(comment.id):
+                    continue
+
+                table = tables.get(str(comment.subreddit).lower())
+                if table is None:
+                    logger.error('no table for /r/{} comment {}'.format(
+                            comment.subreddit, comment.id))
+                    continue
+                await writer.add(table, bulk_writer.COMMENT_COLUMNS,
+                        harvest.comment_record(comment))
+                counts['comments'] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(e)
+            attempt += 1
+            delay = await budget.backoff(attempt)
+            logger.info('reconnecting to stream after {:.1f}s'.format(delay))
+
+async def _stream_submissions(reddit, names, ids, budget, writer, counts):
+    """Follow the submissions of one combined listing into reddit_submissions."""
+    attempt = 0
+    while True:
+        try:
+            subreddit = await reddit.subreddit('+'.join(names))
+            async for submission in subreddit.stream.submissions(pause_after=-1):
+                attempt = 0
+                budget.update(reddit)
+                if submission is None or not ids.add(submission.id):
+                    continue
+                await writer.add('reddit_submissions',
+                        bulk_writer.SUBMISSION_COLUMNS,
+                        harvest.submission_record(submission))
+                counts['submissions'] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(e)
+            attempt += 1
+            delay = await budget.backoff(attempt)
+            logger.info('reconnecting to stream after {:.1f}s'.format(delay))
+
+async def _report(message, interval=5):
+    while True:
+        await asyncio.sleep(interval)
+        sys.stdout.write('\r' + message())
+        sys.stdout.flush()
+
+async def run_stream(config, subreddits, tables, ids, batch_rows=500,
+        batch_ms=1000, submission_ids=None):
+    """Stream comments of many subreddits on one event loop.
+
+    Subreddits are split into combined listings of LISTING_SIZE which are
+    followed concurrently over one session and rate budget; comments, and
+    submissions given submission_ids, are group-committed through an
+    AsyncBatchWriter.
+
+    Arguments:
+        config          - parsed config holding reddit and database credentials
+        subreddits      - list of subreddit names
+        tables          - dictionary mapping lower case subreddit names to tables
+        ids             - subreddit_stream.RecentIds of comments already logged
+        submission_ids  - RecentIds of submissions already logged, or None to
+                          leave submissions alone
+    """
+    pool = await connect_pool(config)
+    reddit = instantiate_reddit(config)
+    budget = AsyncRateBudget()
+    writer = AsyncBatchWriter(pool, batch_rows, batch_ms)
+    writer.start()
+    counts = {'comments': 0, 'submissions': 0}
+
+    tasks = list()
+    for n in range(0, len(subreddits), LISTING_SIZE):
+        names = subreddits[n:n + LISTING_SIZE]
+        tasks.append(asyncio.ensure_future(_stream_listing(
+                reddit, names, tables, ids, budget, writer, counts)))
+        if submission_ids is not None:
+            tasks.append(asyncio.ensure_future(_stream_submissions(
+                    reddit, names, submission_ids, budget, writer, counts)))
+    tasks.append(asyncio.ensure_future(_report(lambda:
+            '{} logged {} comments and {} submissions from {} subreddits | {} | {}'.format(
+                    datetime.datetime.now(), counts['comments'],
+                    counts['submissions'], len(tables), writer.describe(),
+                    budget.describe()))))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await writer.close()
+        await reddit.close()
+        await pool.close()
+
+async def _fetch_submission(reddit, budget, writer, table, s_id, counts):
+    try:
+        submission = await budget.call(reddit, reddit.submission, s_id)
+        await submission.comments.replace_more(limit=0)
+        for comment in submission.comments.list():
+            await writer.add(table, bulk_writer.COMMENT_COLUMNS,
+                    harvest.comment_record(comment))
+        # Only a fully queued submission is checkpointed; a failed one is
+        #   left for a resumed job to retry
+        await writer.done(s_id)
+    except Exception as e:
+        logger.exception(e)
+        logger.error('could not fetch submission {}'.format(s_id))
+    counts['submissions'] += 1
+
+async def _fetch_worker(reddit, budget, writer, table, pending, counts):
+    while len(pending) > 0:
+        s_id = pending.pop()
+        await _fetch_submission(reddit, budget, writer, table, s_id, counts)
+
+async def run_backfill(config, subreddit_name, ids, destination_table,
+        unsafe=False, concurrency=8, batch_rows=5000, batch_ms=30000,
+        queue_size=20000, job=None):
+    """Fetch the comments of many submissions concurrently on one event loop.
+
+    concurrency coroutines fetch comment trees under one rate budget and
+    push comments onto the writer's bounded queue; checkpointed submissions
+    are marked completed in the transaction that writes their comments.
+
+    Arguments mirror subreddit_comments.collect_comments.
+    """
+    pool = await connect_pool(config)
+    reddit = instantiate_reddit(config)
+    budget = AsyncRateBudget()
+    writer = AsyncBatchWriter(pool, batch_rows, batch_ms, queue_size,
+            dedupe=not unsafe, job=job)
+    writer.start()
+    counts = {'submissions': 0}
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+
+    # Pop from the end so submissions are fetched in the order given
+    pending = list(reversed(ids))
+    workers = [asyncio.ensure_future(_fetch_worker(
+            reddit, budget, writer, destination_table, pending, counts))
+            for n in range(max(concurrency, 1))]
+    reporter = asyncio.ensure_future(_report(lambda:
+            'Processing {} of {} submissions in {} ({:.2f} submissions/s, {}, {})'.format(
+                    counts['submissions'], len(ids), subreddit_name,
+                    counts['submissions'] / max(loop.time() - started, 0.001),
+                    writer.describe(), budget.describe())))
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers + [reporter]:
+            task.cancel()
+        await writer.close()
+        await reddit.close()
+        await pool.close()
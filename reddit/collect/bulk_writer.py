@@ -0,0 +1,598 @@
+#
+# Bulk write records to the database through COPY.
+#
+# A batch of records (dictionaries keyed by column name) is streamed into a
+# temporary staging table with COPY ... FROM STDIN and then merged into the
+# destination table with a single INSERT ... SELECT. Deduplication happens in
+# the database: the merge anti-joins against the destination and ignores
+# conflicts on its unique id constraint, so skipped counts come back from
+# postgres. A row postgres refuses is isolated by splitting the batch and is
+# quarantined to the reddit_quarantine table rather than failing the whole
+# batch.
+#
+# BatchWriter group-commits rows that arrive one at a time, as from a stream.
+# Given a Spool it keeps accepting rows while the database is unreachable:
+# batches are appended to a local file and replayed once it reconnects. Only
+# a lost connection spools; a table that can't be written at all has its rows
+# quarantined so the other tables keep being committed.
+#
+# Shared by the comment, stream, submission and redditor history collectors.
+#
+
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+
+logger = logging.getLogger('main')
+
+# Columns written by each of the collectors
+COMMENT_COLUMNS = (
+        'id', 'parent_id', 'link_id', 'author', 'created', 'created_utc',
+        'author_flair_text', 'author_flair_css', 'edited', 'body')
+
+SUBMISSION_COLUMNS = (
+        'id', 'subreddit', 'author', 'author_flair_text', 'author_flair_css',
+        'created', 'created_utc', 'domain', 'downs', 'ups', 'score',
+        'num_comments', 'name', 'permalink', 'url', 'selftext', 'title')
+
+# Columns of a submission that change after it's collected
+SUBMISSION_REFRESH_COLUMNS = ('id', 'score', 'ups', 'downs', 'num_comments')
+
+USER_COMMENT_COLUMNS = (
+        'id', 'author', 'subreddit', 'created', 'created_utc',
+        'author_flair_text', 'author_flair_css', 'link_permalink', 'body')
+
+QUARANTINE_TABLE = 'reddit_quarantine'
+
+def _copy_value(value):
+    """Format a single value for the COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    value = str(value)
+    return value.replace('\\', '\\\\') \
+            .replace('\t', '\\t') \
+            .replace('\n', '\\n') \
+            .replace('\r', '\\r')
+
+def _copy_buffer(rows, columns):
+    """Return a file-like object holding rows in the COPY text format."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(_copy_value(row.get(c)) for c in columns))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+def staging_table(table):
+    return '_staging_{table}'.format(table=table)
+
+def merge_sql(table, staging, columns):
+    """Return the statement merging staged rows into the destination.
+
+    DISTINCT ON drops repeats within the batch, the anti-join drops ids
+    already stored and ON CONFLICT covers rows written concurrently. The
+    first column is taken to be the id.
+    """
+    return '''
+        INSERT INTO {table} ({columns})
+        SELECT DISTINCT ON (s.{key}) {staged_columns}
+        FROM {staging} s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {table} t WHERE t.{key} = s.{key})
+        ON CONFLICT DO NOTHING;
+    '''.format(
+            table=table,
+            staging=staging,
+            key=columns[0],
+            columns=', '.join(columns),
+            staged_columns=', '.join('s.' + c for c in columns))
+
+def _create_staging(cursor, table):
+    """Create a session-local staging table shaped like the destination.
+
+    Rows are removed from the staging table on every commit so it can be
+    reused by each batch written in this session.
+    """
+    sql = '''
+        CREATE TEMPORARY TABLE IF NOT EXISTS {staging}
+            (LIKE {table} INCLUDING DEFAULTS)
+            ON COMMIT DELETE ROWS;
+    '''.format(staging=staging_table(table), table=table)
+    cursor.execute(sql)
+
+def _copy_rows(cursor, table, columns, rows):
+    """COPY rows into table, splitting the batch to isolate rejected rows.
+
+    Each attempt runs under a savepoint so a rejected COPY leaves the rows
+    already staged untouched.
+
+    Returns a list of (row, error) tuples for rows that could not be copied.
+    """
+    if len(rows) == 0:
+        return list()
+
+    sql = 'COPY {table} ({columns}) FROM STDIN'.format(
+            table=table, columns=', '.join(columns))
+    cursor.execute('SAVEPOINT bulk_copy;')
+    try:
+        cursor.copy_expert(sql, _copy_buffer(rows, columns))
+        cursor.execute('RELEASE SAVEPOINT bulk_copy;')
+        return list()
+    except Exception as e:
+        cursor.execute('ROLLBACK TO SAVEPOINT bulk_copy;')
+        cursor.execute('RELEASE SAVEPOINT bulk_copy;')
+        if len(rows) == 1:
+            return [(rows[0], str(e).strip())]
+
+    middle = len(rows) // 2
+    return _copy_rows(cursor, table, columns, rows[:middle]) + \
+            _copy_rows(cursor, table, columns, rows[middle:])
+
+def _quarantine(cursor, table, rejected):
+    """Record rejected rows so they can be inspected and replayed later."""
+    sql = '''
+        INSERT INTO {quarantine} (table_name, id, record, error)
+        VALUES (%(table_name)s, %(id)s, %(record)s, %(error)s);
+    '''.format(quarantine=QUARANTINE_TABLE)
+    for row, error in rejected:
+        logger.error('quarantined {} row {}: {}'.format(table, row.get('id'), error))
+        cursor.execute('SAVEPOINT bulk_quarantine;')
+        try:
+            cursor.execute(sql, {
+                    'table_name': table,
+                    'id': row.get('id'),
+                    'record': json.dumps(row, default=str),
+                    'error': error})
+            cursor.execute('RELEASE SAVEPOINT bulk_quarantine;')
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT bulk_quarantine;')
+            logger.exception(e)
+            logger.error(row)
+
+def write_rows(conn, table, columns, rows, dedupe=True, commit=True):
+    """Bulk write a batch of rows to a table.
+
+    Arguments:
+        conn    - psycopg2 connection
+        table   - destination table USED IN CRAFTING OUR SQL!
+        columns - sequence of column names to write, the first being the id
+        rows    - list of dictionaries keyed by column name
+        dedupe  - merge through the staging table, skipping ids already in
+                  the destination; when False rows are COPYed straight into
+                  the destination and duplicates are left to the constraint
+        commit  - commit the transaction once the batch is merged
+
+    Returns inserted_rows, skipped_rows, failed_rows
+
+    Note:
+    This function is NOT AT ALL SAFE for public use.
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+
+        if not dedupe:
+            rejected = _copy_rows(cursor, table, columns, rows)
+            if len(rejected) > 0:
+                _quarantine(cursor, table, rejected)
+            if commit:
+                conn.commit()
+            return len(rows) - len(rejected), 0, len(rejected)
+
+        _create_staging(cursor, table)
+
+        staging = staging_table(table)
+        rejected = _copy_rows(cursor, staging, columns, rows)
+        if len(rejected) > 0:
+            _quarantine(cursor, table, rejected)
+
+        cursor.execute(merge_sql(table, staging, columns))
+        inserted_rows = cursor.rowcount
+        skipped_rows = len(rows) - len(rejected) - inserted_rows
+
+        # Staged rows are dropped on commit; without one clear them ourselves
+        #   so the next batch starts from an empty staging table.
+        if commit:
+            conn.commit()
+        else:
+            cursor.execute('TRUNCATE {staging};'.format(staging=staging))
+
+        return inserted_rows, skipped_rows, len(rejected)
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def update_rows(conn, table, columns, rows, commit=True):
+    """Bulk update columns of rows already in a table.
+
+    Rows are staged as with write_rows and applied with a single
+    UPDATE ... FROM, which leaves alone every other column and every row
+    whose values haven't changed.
+
+    Arguments:
+        conn    - psycopg2 connection
+        table   - destination table USED IN CRAFTING OUR SQL!
+        columns - sequence of column names to update, the first being the id
+        rows    - list of dictionaries keyed by column name
+        commit  - commit the transaction once the batch is applied
+
+    Returns updated_rows, unchanged_rows, failed_rows
+
+    Note:
+    This function is NOT AT ALL SAFE for public use.
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        _create_staging(cursor, table)
+
+        staging = staging_table(table)
+        rejected = _copy_rows(cursor, staging, columns, rows)
+        if len(rejected) > 0:
+            _quarantine(cursor, table, rejected)
+
+        sql = '''
+            UPDATE {table} t
+            SET {assignments}
+            FROM (SELECT DISTINCT ON ({key}) * FROM {staging}) s
+            WHERE t.{key} = s.{key}
+                AND ({current}) IS DISTINCT FROM ({staged});
+        '''.format(
+                table=table,
+                staging=staging,
+                key=columns[0],
+                assignments=', '.join('{c} = s.{c}'.format(c=c) for c in columns[1:]),
+                current=', '.join('t.' + c for c in columns[1:]),
+                staged=', '.join('s.' + c for c in columns[1:]))
+        cursor.execute(sql)
+        updated_rows = cursor.rowcount
+        unchanged_rows = len(rows) - len(rejected) - updated_rows
+
+        if commit:
+            conn.commit()
+        else:
+            cursor.execute('TRUNCATE {staging};'.format(staging=staging))
+
+        return updated_rows, unchanged_rows, len(rejected)
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+class Spool(object):
+    """Append-only local file of rows waiting for the database.
+
+    Each row is one line of JSON naming its table and columns. A batch is
+    fsynced once, after all of its rows are written, so a crash loses at most
+    the batch being appended. A torn last line left by a crash is cut off
+    when the spool is opened, so rows appended after it are read intact.
+
+    Arguments:
+        path    - spool file; rows left by an earlier run are kept
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        if os.path.exists(path):
+            self._repair()
+        self._file = open(path, 'a')
+
+    def _repair(self):
+        """Count the complete lines and truncate a torn tail after them."""
+        end = 0
+        with open(self.path, 'rb') as fin:
+            for line in fin:
+                if not line.endswith(b'\n'):
+                    break
+                end += len(line)
+                self.rows += 1
+        if end < os.path.getsize(self.path):
+            logger.warning('cut a torn line off the end of {}'.format(self.path))
+            with open(self.path, 'r+b') as fout:
+                fout.truncate(end)
+                fout.flush()
+                os.fsync(fout.fileno())
+
+    def append(self, pending):
+        """Append a batch of rows keyed by (table, columns) and fsync."""
+        n = 0
+        for (table, columns), rows in pending.items():
+            for row in rows:
+                self._file.write(json.dumps({
+                        'table': table,
+                        'columns': columns,
+                        'row': row}, default=str))
+                self._file.write('\n')
+                n += 1
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.rows += n
+
+    def read(self):
+        """Return the spooled rows grouped by (table, columns)."""
+        pending = dict()
+        with open(self.path, 'r') as fin:
+            for line in fin:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning('skipped a torn line in {}'.format(self.path))
+                    continue
+                key = (record['table'], tuple(record['columns']))
+                pending.setdefault(key, list()).append(record['row'])
+        return pending
+
+    def clear(self):
+        """Empty the spool once its rows are committed."""
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.rows = 0
+
+    def close(self):
+        self._file.close()
+
+class BatchWriter(object):
+    """Group-commit rows written one at a time.
+
+    Rows are buffered per table and written with write_rows in a single
+    transaction every batch_rows rows or every batch_ms milliseconds,
+    whichever comes first, so bursts don't pay for a commit per row. A
+    background thread flushes batches that are due while no rows arrive.
+
+    Each table's rows are written under their own savepoint. A table that
+    can't be written for any reason but a lost connection, such as one that
+    was never created, has its rows quarantined and the rest of the batch is
+    committed.
+
+    With a spool, a batch is appended to the spool instead of being lost
+    when the connection is, and later batches follow it there until the
+    spool has been replayed, so rows stay in order and add() never waits on
+    an outage. The background thread reconnects with connect every
+    retry_seconds and replays the spool in one transaction; rows committed
+    just before a crash are replayed again and skipped by the merge.
+
+    Arguments:
+        conn            - psycopg2 connection
+        batch_rows      - rows buffered before a commit
+        batch_ms        - longest time in milliseconds a row waits for a commit
+        spool           - Spool holding rows while the database is down
+        connect         - callable returning a new connection, or None on
+                          failure; without it the same connection is retried
+        retry_seconds   - seconds between attempts to reconnect and replay
+    """
+
+    def __init__(self, conn, batch_rows=500, batch_ms=1000, spool=None,
+            connect=None, retry_seconds=30):
+        self.conn = conn
+        self.batch_rows = batch_rows
+        self.batch_ms = batch_ms
+        self.spool = spool
+        self.connect = connect
+        self.retry_seconds = retry_seconds
+        self._lock = threading.RLock()
+        self._pending = dict()
+        self._n_pending = 0
+        self._oldest = None
+        self._next_retry = time.time()
+        self._closed = threading.Event()
+        self.commits = 0
+        self.rows = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.replayed = 0
+        self.commit_seconds = 0.0
+
+        self._timer = threading.Thread(target=self._flush_when_due)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def add(self, table, columns, row):
+        """Buffer a row for table, flushing if the batch is full."""
+        with self._lock:
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._pending.setdefault((table, tuple(columns)), list()).append(row)
+            self._n_pending += 1
+            if self._n_pending >= self.batch_rows:
+                self.flush()
+
+    def _due(self):
+        return self._oldest is not None and \
+                (time.time() - self._oldest) * 1000 >= self.batch_ms
+
+    def _spooling(self):
+        return self.spool is not None and \
+                (self.conn is None or self.spool.rows > 0)
+
+    def _flush_when_due(self):
+        while not self._closed.wait(self.batch_ms / 4000.0):
+            if self._spooling() and time.time() >= self._next_retry:
+                self._recover()
+            with self._lock:
+                if self._due():
+                    self.flush()
+
+    def _disconnected(self, error):
+        """Whether error means the connection, not the rows, is at fault.
+
+        OperationalError alone isn't enough: statement timeouts, deadlocks
+        and a full disk raise it on a live connection. A connection the
+        server dropped is marked closed by psycopg2.
+        """
+        return isinstance(error, psycopg2.InterfaceError) or bool(self.conn.closed)
+
+    def _write(self, pending):
+        """Write batches keyed by (table, columns) in one transaction.
+
+        A table whose rows fail for a reason other than a lost connection is
+        rolled back to its savepoint and its rows are quarantined.
+        """
+        counts = [0, 0, 0]
+        cursor = self.conn.cursor()
+        try:
+            for (table, columns), rows in pending.items():
+                cursor.execute('SAVEPOINT batch_table;')
+                try:
+                    table_counts = write_rows(
+                            self.conn, table, columns, rows, commit=False)
+                    cursor.execute('RELEASE SAVEPOINT batch_table;')
+                except Exception as e:
+                    if self._disconnected(e):
+                        raise
+                    cursor.execute('ROLLBACK TO SAVEPOINT batch_table;')
+                    cursor.execute('RELEASE SAVEPOINT batch_table;')
+                    logger.error('could not write {} rows to {}: {}'.format(
+                            len(rows), table, str(e).strip()))
+                    _quarantine(cursor, table, [(row, str(e).strip()) for row in rows])
+                    table_counts = (0, 0, len(rows))
+                for n, count in enumerate(table_counts):
+                    counts[n] += count
+            self.conn.commit()
+            return counts
+
+        finally:
+            cursor.close()
+
+    def _failed(self):
+        """Roll back after a failed write, dropping a broken connection."""
+        try:
+            self.conn.rollback()
+        except Exception as e:
+            logger.debug(e)
+        if self.connect is not None and self.conn.closed:
+            logger.error('lost the database connection')
+            self.conn = None
+        self._next_retry = time.time() + self.retry_seconds
+
+    def _quarantine_all(self, pending, error):
+        """Quarantine a batch that failed as a whole though still connected.
+
+        Returns True once the rows are committed to the quarantine table.
+        """
+        cursor = None
+        try:
+            cursor = self.conn.cursor()
+            for (table, columns), rows in pending.items():
+                _quarantine(cursor, table, [(row, str(error).strip()) for row in rows])
+            self.conn.commit()
+            return True
+
+        except Exception as e:
+            logger.exception(e)
+            self._failed()
+            return False
+
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    def _recover(self):
+        """Reconnect if need be and replay the spool."""
+        self._next_retry = time.time() + self.retry_seconds
+        if self.conn is None:
+            # Connect outside the lock so rows keep spooling meanwhile
+            conn = self.connect()
+            if conn is None:
+                return
+            logger.info('reconnected to the database')
+            with self._lock:
+                self.conn = conn
+
+        with self._lock:
+            if self.spool.rows == 0:
+                return
+            logger.info('replaying {} spooled rows'.format(self.spool.rows))
+            pending = self.spool.read()
+            try:
+                counts = self._write(pending)
+            except Exception as e:
+                logger.exception(e)
+                if self._disconnected(e):
+                    self._failed()
+                    return
+                # Replaying the same rows would fail again forever
+                self._failed()
+                if not self._quarantine_all(pending, e):
+                    return
+                counts = (0, 0, sum(len(rows) for rows in pending.values()))
+            self.replayed += self.spool.rows
+            self.inserted += counts[0]
+            self.skipped += counts[1]
+            self.failed += counts[2]
+            self.spool.clear()
+
+    def flush(self):
+        """Write and commit every buffered row in one transaction."""
+        with self._lock:
+            if self._n_pending == 0:
+                return
+            pending = self._pending
+            n_pending = self._n_pending
+            self._pending = dict()
+            self._n_pending = 0
+            self._oldest = None
+
+            if self._spooling():
+                self.spool.append(pending)
+                return
+
+            started = time.time()
+            try:
+                counts = self._write(pending)
+            except Exception as e:
+                logger.exception(e)
+                disconnected = self._disconnected(e)
+                self._failed()
+                if disconnected and self.spool is not None:
+                    logger.warning('spooling to {} until the database is back'.format(
+                            self.spool.path))
+                    self.spool.append(pending)
+                elif disconnected or not self._quarantine_all(pending, e):
+                    logger.error('lost a batch of {} rows'.format(n_pending))
+                    self.failed += n_pending
+                else:
+                    self.failed += n_pending
+                return
+
+            self.commit_seconds += time.time() - started
+            self.commits += 1
+            self.rows += n_pending
+            self.inserted += counts[0]
+            self.skipped += counts[1]
+            self.failed += counts[2]
+
+    def close(self):
+        """Flush what's buffered and stop the background flushes."""
+        self._closed.set()
+        self._timer.join()
+        if self._spooling():
+            self._recover()
+        self.flush()
+        logger.info('{} rows in {} commits; {}'.format(
+                self.rows, self.commits, self.describe()))
+        if self.spool is not None:
+            if self.spool.rows > 0:
+                logger.warning('{} rows left in {} for the next run'.format(
+                        self.spool.rows, self.spool.path))
+            self.spool.close()
+
+    def describe(self):
+        """Short summary of the achieved batching for progress output."""
+        if self.spool is not None and self.spool.rows > 0:
+            return '{} rows spooled'.format(self.spool.rows)
+        if self.commits == 0:
+            return 'no commits yet'
+        return '{:.1f} rows/commit, {:.0f} ms/commit'.format(
+                float(self.rows) / self.commits,
+                self.commit_seconds / self.commits * 1000)
@@ -0,0 +1,168 @@
+#
+# Persist the progress of long backfills so a restarted job resumes.
+#
+# A job is identified by (subreddit, start_date, end_date). Once the
+# submission ids of a job are harvested they're stored along with the job,
+# and each submission is marked completed in the same transaction that writes
+# its comments. See sql/schema/checkpoint_table.sql.
+#
+# Submission ids enumerated by id range (see id_range.py) take hours to find,
+# so the walk saves its position and the ids found so far as it goes; the job
+# counts as harvested only once the walk reaches the end of its range.
+#
+
+import logging
+
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger('main')
+
+def load_job(conn, job):
+    """Return the submission ids of a job still to be collected.
+
+    Arguments:
+        conn    - psycopg2 connection
+        job     - (subreddit, start_date, end_date) tuple
+
+    Returns None when the job's submission ids have not been harvested yet.
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT 1
+            FROM reddit_checkpoint_jobs
+            WHERE subreddit = %s AND start_date = %s AND end_date = %s;
+        ''', job)
+        if cursor.fetchone() is None:
+            return None
+
+        cursor.execute('''
+            SELECT submission_id
+            FROM reddit_checkpoint_submissions
+            WHERE subreddit = %s AND start_date = %s AND end_date = %s
+                AND NOT completed
+            ORDER BY submission_id;
+        ''', job)
+        return [row[0] for row in cursor.fetchall()]
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def save_job(conn, job, ids):
+    """Record the harvested submission ids of a job and commit."""
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        execute_values(cursor, '''
+            INSERT INTO reddit_checkpoint_submissions
+                (subreddit, start_date, end_date, submission_id)
+            VALUES %s
+            ON CONFLICT DO NOTHING;
+        ''', [job + (s_id,) for s_id in ids], page_size=1000)
+        cursor.execute('''
+            INSERT INTO reddit_checkpoint_jobs (subreddit, start_date, end_date)
+            VALUES (%s, %s, %s)
+            ON CONFLICT DO NOTHING;
+        ''', job)
+        conn.commit()
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def mark_completed(conn, job, ids):
+    """Mark submissions of a job as fully written.
+
+    Does not commit; the caller commits along with the comments written so
+    the checkpoint never runs ahead of the data.
+    """
+    if len(ids) == 0:
+        return
+
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE reddit_checkpoint_submissions
+            SET completed = true
+            WHERE subreddit = %s AND start_date = %s AND end_date = %s
+                AND submission_id = ANY(%s);
+        ''', job + (list(ids),))
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def load_position(conn, job):
+    """Return the next submission id, as an integer, of a job's id range walk.
+
+    Returns None when the walk has not saved a position yet.
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT next_id
+            FROM reddit_checkpoint_ranges
+            WHERE subreddit = %s AND start_date = %s AND end_date = %s;
+        ''', job)
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def save_position(conn, job, next_id, ids):
+    """Record how far a job's id range walk got and what it found; commit.
+
+    Arguments:
+        next_id - every id below this integer has been looked up
+        ids     - submission ids found since the last save
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        execute_values(cursor, '''
+            INSERT INTO reddit_checkpoint_submissions
+                (subreddit, start_date, end_date, submission_id)
+            VALUES %s
+            ON CONFLICT DO NOTHING;
+        ''', [job + (s_id,) for s_id in ids], page_size=1000)
+        cursor.execute('''
+            INSERT INTO reddit_checkpoint_ranges
+                (subreddit, start_date, end_date, next_id)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (subreddit, start_date, end_date)
+            DO UPDATE SET next_id = EXCLUDED.next_id, saved_at = now();
+        ''', job + (next_id,))
+        conn.commit()
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def delete_job(conn, job):
+    """Forget a job so it's harvested and collected from scratch."""
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM reddit_checkpoint_submissions
+            WHERE subreddit = %s AND start_date = %s AND end_date = %s;
+        ''', job)
+        cursor.execute('''
+            DELETE FROM reddit_checkpoint_ranges
+            WHERE subreddit = %s AND start_date = %s AND end_date = %s;
+        ''', job)
+        cursor.execute('''
+            DELETE FROM reddit_checkpoint_jobs
+            WHERE subreddit = %s AND start_date = %s AND end_date = %s;
+        ''', job)
+        conn.commit()
+
+    finally:
+        if cursor is not None:
+            cursor.close()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#
+# Track edits and deletions of stored comments.
+#
+# Comments are stored as first collected and never looked at again, so later
+# edits and deletions go unnoticed. This re-fetches stored comments by id,
+# 100 to a request, newest first and on a decaying schedule: a comment is due
+# again once a fraction (--factor) of its age has passed since its last
+# check. Each changed body or deletion is recorded in reddit_comment_history
+# and the comment's edited flag is set in place.
+#
+# Requests are capped at --rate a minute so the job can run continuously
+# beside the stream collectors without eating their rate limit.
+#
+# See sql/schema/comment_history_table.sql.
+#
+
+import argparse
+import configparser
+import datetime
+import logging
+import os
+import sys
+import time
+
+import praw
+import psycopg2
+from psycopg2.extras import execute_values
+
+import scheduler
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('main')
+
+working_dir = os.path.realpath(__file__)
+working_dir = os.path.dirname(working_dir)
+
+# Most ids reddit's info endpoint takes in one request
+INFO_LIMIT = 100
+
+# Bodies reddit shows in place of a deleted or removed comment
+DELETED_BODIES = {'[deleted]': 'deleted', '[removed]': 'removed'}
+
+def _connect_to_db(dh_host, db_name, db_user, db_user_pass):
+    conn = None
+    cursor = None
+
+    connstr = \
+            "host={db_host} " + \
+            "dbname='{db_name}' " + \
+            "user='{db_user}' " + \
+            "password='{db_user_pass}'"
+    connstr = connstr.format(
+                db_host=db_host,
+                db_name=db_name,
+                db_user=db_user,
+                db_user_pass=db_user_pass)
+    try:
+        conn = psycopg2.connect(connstr)
+
+    except Exception as e:
+        logger.exception(e)
+
+    return conn
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Record edits and deletions of stored comments.')
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-t', '--table', action='store', nargs='+',
+            help='comment tables to check')
+    source.add_argument('-m', '--metatable', action='store_true',
+            help='check the table of every subreddit in reddit_subreddits')
+    parser.add_argument('-a', '--max-age', action='store', type=float,
+            default=30, help='check comments up to this many days old')
+    parser.add_argument('-f', '--factor', action='store', type=float,
+            default=0.25,
+            help='check again once this fraction of its age has passed')
+    parser.add_argument('--min-interval', action='store', type=float,
+            default=60, help='least minutes between checks of a comment')
+    parser.add_argument('-r', '--rate', action='store', type=float,
+            default=20, help='most requests a minute')
+    parser.add_argument('-b', '--batch', action='store', type=int,
+            default=10000, help='comments read from the database at a time')
+    parser.add_argument('-l', '--loop', action='store_true',
+            help='keep checking as comments fall due instead of exiting')
+    parser.add_argument('-d', '--debug', action='store_true')
+
+    args = parser.parse_args()
+    return args
+
+def parse_config():
+    config = configparser.ConfigParser()
+    config.read_file(open(os.path.join(working_dir, '../config.conf')))
+    return config
+
+def _get_metatable_subreddits():
+    """Get the subreddits listed in the reddit_subreddits metatable."""
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT subreddit FROM reddit_subreddits;')
+        return [row[0] for row in cursor.fetchall()]
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _get_due_comments(table, max_age, factor, min_interval, limit):
+    """Get comments of a table due a check, newest first.
+
+    Returns a list of (id, body, change) tuples where body is the latest
+    known body and change the last change recorded, if it changed since it
+    was stored.
+
+    Note:
+    This function is NOT AT ALL SAFE for public use.
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+
+        # created_utc is stored in local time, as is now
+        now = datetime.datetime.now()
+        sql = '''
+            SELECT c.id,
+                CASE WHEN h.change IS NULL THEN c.body ELSE h.new_body END,
+                h.change
+            FROM {table} c
+            LEFT JOIN reddit_comment_checks k
+                ON k.table_name = %(table)s AND k.id = c.id
+            LEFT JOIN LATERAL (
+                SELECT change, new_body
+                FROM reddit_comment_history
+                WHERE table_name = %(table)s AND id = c.id
+                ORDER BY detected_at DESC
+                LIMIT 1) h ON true
+            WHERE c.created_utc > %(oldest)s
+                AND (k.checked_at IS NULL
+                    OR k.checked_at < %(now)s - GREATEST(
+                        %(min_interval)s, (%(now)s - c.created_utc) * %(factor)s))
+            ORDER BY c.created_utc DESC
+            LIMIT %(limit)s;
+        '''.format(table=table)
+        cursor.execute(sql, {
+                'table': table,
+                'now': now,
+                'oldest': now - max_age,
+                'min_interval': min_interval,
+                'factor': factor,
+                'limit': limit})
+        return cursor.fetchall()
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _change(old_body, comment):
+    """Classify how a re-fetched comment differs from its known body."""
+    if comment is None:
+        return 'missing'
+    if comment.body == old_body:
+        return None
+    if comment.body in DELETED_BODIES:
+        return DELETED_BODIES[comment.body]
+    return 'edited'
+
+def _save_checks(table, changes, ids):
+    """Record changes and check times, flagging changed comments edited.
+
+    Does not commit.
+
+    Note:
+    This function is NOT AT ALL SAFE for public use.
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        if len(changes) > 0:
+            execute_values(cursor, '''
+                INSERT INTO reddit_comment_history
+                    (table_name, id, change, old_body, new_body)
+                VALUES %s;
+            ''', [(table,) + change for change in changes])
+            cursor.execute('''
+                UPDATE {table}
+                SET edited = true
+                WHERE id = ANY(%s) AND edited IS NOT true;
+            '''.format(table=table), ([change[0] for change in changes],))
+
+        now = datetime.datetime.now()
+        execute_values(cursor, '''
+            INSERT INTO reddit_comment_checks (table_name, id, checked_at)
+            VALUES %s
+            ON CONFLICT (table_name, id)
+            DO UPDATE SET checked_at = EXCLUDED.checked_at;
+        ''', [(table, c_id, now) for c_id in ids])
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def revalidate_comments(reddit, budget, table, comments):
+    """Re-fetch comments by id and record how they've changed.
+
+    Each request looks up INFO_LIMIT comments and is committed along with
+    what it found. A comment missing from the response is recorded once as
+    'missing'.
+
+    Arguments:
+        comments    - list of (id, latest known body, last change) tuples
+
+    Returns a dictionary counting each kind of change.
+    """
+    counts = dict()
+    for n in range(0, len(comments), INFO_LIMIT):
+        chunk = comments[n:n + INFO_LIMIT]
+        fetched = budget.call(reddit, lambda: list(reddit.info(
+                fullnames=['t1_' + c_id for c_id, body, last in chunk])))
+        fetched = {comment.id: comment for comment in fetched}
+
+        changes = list()
+        for c_id, old_body, last_change in chunk:
+            comment = fetched.get(c_id)
+            change = _change(old_body, comment)
+            if change is None or (change == 'missing' and last_change == 'missing'):
+                continue
+            new_body = None if comment is None else comment.body.replace('\x00', '')
+            changes.append((c_id, change, old_body, new_body))
+            counts[change] = counts.get(change, 0) + 1
+
+        _save_checks(table, changes, [c_id for c_id, body, last in chunk])
+        conn.commit()
+
+        sys.stdout.write('\r{} checked {} of {} comments | {} | {}'.format(
+                table, min(n + INFO_LIMIT, len(comments)), len(comments),
+                ', '.join('{} {}'.format(v, k) for k, v in sorted(counts.items()))
+                        or 'no changes',
+                budget.describe()))
+        sys.stdout.flush()
+    if len(comments) > 0:
+        print()
+
+    return counts
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    config = parse_config()
+
+    if args.debug:
+        logger.level = logging.DEBUG
+
+    db_host = config['DEFAULT']['db_host']
+    db_name = config['DEFAULT']['db_name']
+    db_user = config['DEFAULT']['db_user']
+    db_pass = config['DEFAULT']['db_pass']
+
+    logger.debug('instantiate reddit object')
+    reddit = praw.Reddit(
+            client_id = config['DEFAULT']['reddit_client_id'],
+            client_secret = config['DEFAULT']['reddit_client_secret'],
+            user_agent = config['DEFAULT']['reddit_user_agent'])
+    budget = scheduler.RateBudget(max_per_minute=args.rate)
+
+    global conn
+    conn = None
+    try:
+        logger.debug('connect to database')
+        conn = _connect_to_db(db_host, db_name, db_user, db_pass)
+        if conn is None:
+            sys.exit(1)
+
+        tables = args.table or _get_metatable_subreddits()
+        max_age = datetime.timedelta(days=args.max_age)
+        min_interval = datetime.timedelta(minutes=args.min_interval)
+        while True:
+            for table in tables:
+                # A full batch means more of the table may be due
+                while True:
+                    logger.debug('get comments of {} due a check'.format(table))
+                    comments = _get_due_comments(table, max_age, args.factor,
+                            min_interval, args.batch)
+                    counts = revalidate_comments(reddit, budget, table, comments)
+                    logger.info('{}: {} comments checked; {}'.format(
+                            table, len(comments), counts or 'no changes'))
+                    if len(comments) < args.batch:
+                        break
+
+            if not args.loop:
+                break
+            time.sleep(min_interval.total_seconds())
+
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('exiting')
+
+    except Exception as e:
+        logger.exception(e)
+
+    finally:
+        if not conn is None:
+            conn.close()
+
+    sys.exit(0)
@@ -0,0 +1,312 @@
+#
+# Search a subreddit's submissions by time range.
+#
+# A search returns at most SEARCH_LIMIT of the newest submissions in a window.
+# Rather than paging backwards one window at a time, harvest_submissions
+# keeps the full page a window returns and splits the rest of that window in
+# two, so non-overlapping sub-windows can be searched concurrently. Pages can
+# be handed on as they arrive so they're written while the harvest goes on.
+# A window whose search keeps failing is retried a few times; if it still
+# fails the harvest is reported incomplete rather than quietly short.
+#
+# submission_record and comment_record convert a submission or comment,
+# however it was found, into a reddit_submissions or reddit_comments row, so
+# the threaded, stream and async collectors all write the same row shape.
+#
+# Shared by the subreddit_comments, subreddit_submissions and subreddit_stream
+# collectors and by async_engine.
+#
+
+import datetime
+import logging
+import queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger('main')
+
+# Most submissions a single search request returns
+SEARCH_LIMIT = 100
+
+# Times a failed window is queued again before the harvest gives up on it
+WINDOW_RETRIES = 3
+
+def search_subreddit(subreddit, start_epoch, end_epoch):
+    """Return a list of submissions between start and end epoch.
+
+    Arguments:
+        subreddit   - praw subreddit object
+        start_epoch - float
+        end_epoch   - float
+    """
+
+    query = 'timestamp:{start_epoch}..{end_epoch}'.format(
+            start_epoch=int(start_epoch), end_epoch=int(end_epoch))
+    submissions = subreddit.search(
+            query,
+            sort='new',
+            syntax='cloudsearch',
+            limit=SEARCH_LIMIT)
+
+    return list(submissions)
+
+def submission_record(submission):
+    """Convert a PRAW submission into a dictionary keyed by column name."""
+    return {
+            'id': submission.id,
+            'subreddit': submission.subreddit.display_name,
+            'author': str(submission.author).replace('\x00', ''),
+            'author_flair_text': submission.author_flair_text,
+            'author_flair_css': submission.author_flair_css_class,
+            'created': datetime.datetime.fromtimestamp(submission.created),
+            'created_utc': datetime.datetime.fromtimestamp(submission.created_utc),
+            'domain': submission.domain,
+            'downs': submission.downs,
+            'ups': submission.ups,
+            'score': submission.score,
+            'num_comments': submission.num_comments,
+            'name': submission.name,
+            'permalink': submission.permalink,
+            'url': submission.url,
+            'selftext': submission.selftext.replace('\x00', ''),
+            'title': submission.title
+    }
+
+def comment_record(comment):
+    """Convert a PRAW or asyncpraw comment into a dictionary keyed by column name."""
+    return {
+            'id': comment.id,
+            'parent_id': comment.parent_id,
+            'link_id': comment.link_id,
+            'author': str(comment.author).replace('\x00', ''),
+            'created': datetime.datetime.fromtimestamp(comment.created),
+            'created_utc': datetime.datetime.fromtimestamp(comment.created_utc),
+            'author_flair_text':comment.author_flair_text,
+            'author_flair_css':comment.author_flair_css_class,
+            'edited': bool(comment.edited),
+            'body': comment.body.replace('\x00', '')
+    }
+
+def _get_cached_genesis(conn, subreddit_name):
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT origin_epoch
+            FROM reddit_subreddit_genesis
+            WHERE subreddit = %(subreddit)s;
+        ''', {'subreddit': subreddit_name})
+        row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    except Exception as e:
+        logger.exception(e)
+        conn.rollback()
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _cache_genesis(conn, subreddit_name, origin):
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO reddit_subreddit_genesis (subreddit, origin_epoch)
+            VALUES (%(subreddit)s, %(origin)s)
+            ON CONFLICT (subreddit) DO UPDATE
+                SET origin_epoch = EXCLUDED.origin_epoch, found_at = now();
+        ''', {'subreddit': subreddit_name, 'origin': origin})
+        conn.commit()
+
+    except Exception as e:
+        logger.exception(e)
+        conn.rollback()
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def get_genesis_post(conn, subreddit, end_epoch=None):
+    '''Find the subreddit's first post by bisecting on time.
+
+    The origin submission for a subreddit would be the very first, still
+    accessible, submission. Each probe searches from the epoch up to a
+    midpoint: an empty result moves the lower bound up, a full page moves the
+    upper bound down, and a partial page holds every submission in the window
+    so its oldest is the origin. The origin is cached in
+    reddit_subreddit_genesis and later runs skip the search.
+
+    Arguments:
+        conn        - psycopg2 connection
+        subreddit   - PRAW object
+        end_epoch   - float, latest time to search; defaults to now
+
+    Returns the origin's created epoch, or None when nothing was found.
+    '''
+    subreddit_name = subreddit.display_name
+    origin = _get_cached_genesis(conn, subreddit_name)
+    if origin is not None:
+        logger.debug('cached {} origin submission at {}'.format(
+                subreddit_name, origin))
+        return origin
+
+    low = 0
+    high = int(end_epoch if end_epoch is not None else time.time())
+    probes = 0
+    while low <= high:
+        middle = (low + high) // 2
+        submissions = search_subreddit(subreddit, low, middle)
+        probes += 1
+        sys.stdout.write('\rsearching genesis post for {} before {}'.format(
+                subreddit_name,
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(middle))))
+        sys.stdout.flush()
+
+        if len(submissions) == 0:
+            low = middle + 1
+        elif len(submissions) < SEARCH_LIMIT or low == middle:
+            origin = min(s.created for s in submissions)
+            break
+        else:
+            high = middle
+
+    sys.stdout.write('\rfound {} origin submission in {} searches; epoch is {}\n'.format(
+            subreddit_name, probes, origin))
+    sys.stdout.flush()
+
+    if origin is not None:
+        _cache_genesis(conn, subreddit_name, origin)
+    return origin
+
+def _harvest_window(subreddit, window, windows, found, progress, lock,
+        on_page=None):
+    """Search one window, queueing the sub-windows a full page leaves behind."""
+    start_epoch, end_epoch = window
+    submissions = search_subreddit(subreddit, start_epoch, end_epoch)
+
+    remaining = None
+    if len(submissions) >= SEARCH_LIMIT:
+        # The page holds everything newer than its oldest submission; what's
+        #   older is split in two and harvested independently.
+        oldest = int(min(s.created for s in submissions))
+        # A one second window left whole can be neither split nor narrowed
+        if oldest - start_epoch >= 1 and \
+                ((start_epoch, oldest) != window or oldest - start_epoch > 1):
+            remaining = (start_epoch, oldest)
+        else:
+            logger.warning('more than {} submissions at {}; some are missed'.format(
+                    SEARCH_LIMIT, start_epoch))
+
+    with lock:
+        new = [s for s in submissions if s.id not in found]
+        for s in new:
+            found[s.id] = s.created
+        if remaining is None:
+            progress['covered'] += end_epoch - start_epoch
+        else:
+            progress['covered'] += end_epoch - remaining[1]
+
+    if remaining is not None:
+        start_epoch, end_epoch = remaining
+        middle = (start_epoch + end_epoch) // 2
+        if middle > start_epoch:
+            windows.put((start_epoch, middle))
+            windows.put((middle + 1, end_epoch))
+        else:
+            windows.put(remaining)
+
+    if on_page is not None and len(new) > 0:
+        on_page(new)
+
+def _harvest_worker(make_subreddit, budget, windows, found, progress, lock,
+        on_page=None):
+    subreddit = make_subreddit()
+    while True:
+        window = windows.get()
+        try:
+            if budget is not None:
+                budget.call(subreddit._reddit, _harvest_window,
+                        subreddit, window, windows, found, progress, lock,
+                        on_page)
+            else:
+                _harvest_window(subreddit, window, windows, found, progress,
+                        lock, on_page)
+        except Exception as e:
+            logger.exception(e)
+            logger.error('could not harvest window {}'.format(window))
+            # Queue it again before this attempt is marked done so the
+            #   harvest doesn't finish in between
+            with lock:
+                attempts = progress['attempts'].get(window, 0) + 1
+                progress['attempts'][window] = attempts
+                if attempts > WINDOW_RETRIES:
+                    progress['failed'].append(window)
+            if attempts <= WINDOW_RETRIES:
+                windows.put(window)
+        finally:
+            windows.task_done()
+
+def harvest_submissions(make_subreddit, start_epoch, end_epoch, workers=1,
+        budget=None, on_page=None):
+    """Return the ids of submissions created between start and end epoch.
+
+    The range is split recursively wherever a window hits the search cap and
+    the resulting windows are harvested by a pool of threads. Submissions are
+    deduplicated by id, and only their ids and creation times are kept, so
+    memory stays small over long ranges. Callers wanting the submissions
+    themselves take each page as it arrives through on_page. A window whose
+    search fails is queued again up to WINDOW_RETRIES times.
+
+    Arguments:
+        make_subreddit  - callable returning a praw subreddit object; called
+                          once by each thread so no PRAW session is shared
+        start_epoch     - float
+        end_epoch       - float
+        workers         - number of threads searching windows
+        budget          - scheduler.RateBudget shared by the threads, if any
+        on_page         - callable given each page's newly found PRAW
+                          submissions; called from the harvesting threads
+
+    Returns a list of submission ids, newest first, or None when windows
+    still failed and the harvest is incomplete.
+    """
+    start_epoch = int(start_epoch)
+    end_epoch = int(end_epoch)
+    windows = queue.Queue()
+    windows.put((start_epoch, end_epoch))
+    found = dict()
+    progress = {'covered': 0, 'attempts': dict(), 'failed': list()}
+    lock = threading.Lock()
+
+    for n in range(max(workers, 1)):
+        t = threading.Thread(
+                target=_harvest_worker,
+                args=(make_subreddit, budget, windows, found, progress, lock,
+                        on_page))
+        t.daemon = True
+        t.start()
+
+    # Wait on the queue in short steps so progress is reported and Ctrl-C
+    #   still reaches this thread.
+    total = max(end_epoch - start_epoch, 1)
+    while windows.unfinished_tasks > 0:
+        time.sleep(0.5)
+        with lock:
+            percentage = min(progress['covered'] / total * 100, 100)
+            n_found = len(found)
+        sys.stdout.write('\rharvest submissions {:00.2f}% complete | {} found{}'.format(
+                percentage, n_found,
+                ' | ' + budget.describe() if budget is not None else ''))
+        sys.stdout.flush()
+    windows.join()
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+    if len(progress['failed']) > 0:
+        logger.error('{} windows could not be harvested after {} retries: {}'.format(
+                len(progress['failed']), WINDOW_RETRIES,
+                ' '.join('{}..{}'.format(*w) for w in sorted(progress['failed']))))
+        return None
+    return sorted(found, key=found.get, reverse=True)
@@ -0,0 +1,215 @@
+#
+# Enumerate submissions by walking a range of ids.
+#
+# Submission ids are sequential base 36 numbers, so every submission made
+# between two dates lies between two ids. The ids bounding a date range are
+# estimated by bisecting on created_utc; the range between them is then cut
+# into blocks of INFO_LIMIT ids, each looked up with a single by-id request,
+# and the blocks are shared out among a pool of threads. Submissions outside
+# the target subreddits or dates are dropped.
+#
+# The walk saves its position and the ids found so far through checkpoint.py
+# so an interrupted walk resumes where it left off. A block that keeps
+# failing holds the position back, so a resumed walk looks it up again.
+#
+# Used by subreddit_comments.py --by-id.
+#
+
+import logging
+import queue
+import sys
+import threading
+import time
+
+import checkpoint
+
+logger = logging.getLogger('main')
+
+# Most fullnames reddit's info endpoint takes in one request
+INFO_LIMIT = 100
+
+# Seconds between checkpoints of a walk
+CHECKPOINT_SECONDS = 60
+
+# Times a failed block is queued again before the walk gives up on it
+BLOCK_RETRIES = 3
+
+def to_base36(n):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    s = ''
+    while True:
+        n, r = divmod(n, 36)
+        s = digits[r] + s
+        if n == 0:
+            return s
+
+def from_base36(s):
+    return int(s, 36)
+
+def lookup_block(reddit, first_id):
+    """Return the submissions among INFO_LIMIT ids from first_id up."""
+    fullnames = ['t3_' + to_base36(n) for n in range(first_id, first_id + INFO_LIMIT)]
+    return list(reddit.info(fullnames=fullnames))
+
+def _newest_id(reddit):
+    for submission in reddit.subreddit('all').new(limit=1):
+        return from_base36(submission.id)
+    return None
+
+def estimate_id(reddit, budget, epoch, high=None):
+    """Estimate the first submission id created at or after epoch.
+
+    Bisects on created_utc between the first id and the newest submission,
+    looking up a block of ids at each probe so gaps left by removed
+    submissions don't stall the search.
+
+    Returns an integer id.
+    """
+    low = 0
+    if high is None:
+        high = budget.call(reddit, _newest_id, reddit)
+    probes = 0
+    while high - low > INFO_LIMIT:
+        middle = (low + high) // 2
+        submissions = budget.call(reddit, lookup_block, reddit, middle)
+        probes += 1
+        if len(submissions) == 0:
+            # Nothing survives in this block; treat it as older
+            low = middle
+            continue
+        if min(s.created_utc for s in submissions) < epoch:
+            low = middle
+        else:
+            high = middle
+
+        sys.stdout.write('\rbisecting ids for {}: t3_{} to t3_{}'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch)),
+                to_base36(low), to_base36(high)))
+        sys.stdout.flush()
+
+    sys.stdout.write('\n')
+    logger.debug('estimated id t3_{} for epoch {} in {} probes'.format(
+            to_base36(low), epoch, probes))
+    return low
+
+def _walk_worker(make_reddit, budget, blocks, results, subreddits,
+        start_epoch, end_epoch):
+    reddit = make_reddit()
+    while True:
+        first_id = blocks.get()
+        if first_id is None:
+            return
+        try:
+            submissions = budget.call(reddit, lookup_block, reddit, first_id)
+            ids = [s.id for s in submissions
+                    if s.subreddit.display_name.lower() in subreddits
+                    and start_epoch <= s.created_utc <= end_epoch]
+            results.put((first_id, ids, None))
+        except Exception as e:
+            results.put((first_id, list(), e))
+
+def walk_range(conn, job, make_reddit, subreddits, start_epoch, end_epoch,
+        start_id, end_id, workers=1, budget=None):
+    """Look up every submission id in a range, keeping those of subreddits.
+
+    Blocks of INFO_LIMIT ids are handed to workers threads in order. The
+    position below which every block is done is checkpointed, with the ids
+    found, every CHECKPOINT_SECONDS; a walk with a saved position resumes
+    from there. A failed block is queued again up to BLOCK_RETRIES times;
+    one that still fails is never counted done, so the position stays below
+    it and the job is left unharvested for a rerun to resume. Once the range
+    is walked the job is marked harvested.
+
+    Arguments:
+        conn            - psycopg2 connection for the checkpoints
+        job             - (subreddit, start_date, end_date) of the checkpoint
+        make_reddit     - callable returning a PRAW object; called once by
+                          each thread so no PRAW session is shared
+        subreddits      - set of lower case subreddit names to keep
+        start_epoch     - float
+        end_epoch       - float
+        start_id        - first integer id to look up
+        end_id          - last integer id to look up
+        workers         - number of threads looking up blocks
+        budget          - scheduler.RateBudget shared by the threads
+
+    Returns the number of submissions found, or None when blocks failed and
+    the walk has to be resumed.
+    """
+    position = checkpoint.load_position(conn, job)
+    if position is not None:
+        logger.info('resuming id walk at t3_{}'.format(to_base36(position)))
+        start_id = max(start_id, position)
+
+    first_ids = list(range(start_id, end_id + 1, INFO_LIMIT))
+    blocks = queue.Queue()
+    for first_id in first_ids:
+        blocks.put(first_id)
+    results = queue.Queue()
+
+    threads = list()
+    for n in range(max(workers, 1)):
+        t = threading.Thread(
+                target=_walk_worker,
+                args=(make_reddit, budget, blocks, results, subreddits,
+                        start_epoch, end_epoch))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # Blocks finish out of order; the checkpoint only moves past a block
+    #   once every block before it is done.
+    done = set()
+    next_block = 0
+    found = list()
+    n_found = 0
+    attempts = dict()
+    failed = set()
+    outstanding = len(first_ids)
+    saved_at = time.time()
+    n = 0
+    while outstanding > 0:
+        first_id, ids, error = results.get()
+        outstanding -= 1
+        if error is not None:
+            logger.error('could not look up t3_{}: {}'.format(
+                    to_base36(first_id), error))
+            attempts[first_id] = attempts.get(first_id, 0) + 1
+            if attempts[first_id] <= BLOCK_RETRIES:
+                blocks.put(first_id)
+                outstanding += 1
+            else:
+                failed.add(first_id)
+            continue
+        n += 1
+        found.extend(ids)
+        n_found += len(ids)
+        done.add(first_id)
+        while next_block < len(first_ids) and first_ids[next_block] in done:
+            done.remove(first_ids[next_block])
+            next_block += 1
+
+        if time.time() - saved_at >= CHECKPOINT_SECONDS:
+            position = first_ids[next_block] if next_block < len(first_ids) \
+                    else end_id + 1
+            checkpoint.save_position(conn, job, position, found)
+            found = list()
+            saved_at = time.time()
+
+        sys.stdout.write('\rwalked {} of {} blocks | {} found{}'.format(
+                n, len(first_ids), n_found,
+                ' | ' + budget.describe() if budget is not None else ''))
+        sys.stdout.flush()
+    sys.stdout.write('\n')
+    for t in threads:
+        blocks.put(None)
+
+    position = first_ids[next_block] if next_block < len(first_ids) \
+            else end_id + 1
+    checkpoint.save_position(conn, job, position, found)
+    if len(failed) > 0:
+        logger.error('{} blocks could not be looked up; rerun to resume the '
+                'walk from t3_{}'.format(len(failed), to_base36(position)))
+        return None
+    checkpoint.save_job(conn, job, list())
+    return n_found
@@ -1,20 +1,37 @@
 #!/usr/bin/env python
 #
-# Given a redditor's name, obtain a list of their latest comments (up to
-# 1000 of them) and save them to the database.
+# Given redditors' names, obtain a list of their latest comments and
+# submissions (up to 1000 of each) and save them to the database.
 #
-# The default table to which user comments are stored is "user_comments".
+# Redditors are named on the command line, listed in a file or selected by a
+# query. Their histories are fetched by a pool of threads sharing one request
+# budget and bulk written over a single connection as each one completes;
+# a summary reports what was written, or why it failed, per redditor. With
+# --incremental paging stops at the newest post an earlier run collected for
+# each redditor, so refreshing an active redditor costs a request or two; see
+# sql/schema/redditor_history_table.sql.
+#
+# The default table to which user comments are stored is "user_comments";
+# submissions go to "reddit_submissions" along with those collected by
+# subreddit.
 
 import argparse
+import collections
 import configparser
 import datetime
 import logging
 import os
+import queue
 import sys
+import threading
 
 import praw
 import psycopg2
 
+import bulk_writer
+import harvest
+import scheduler
+
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger('main')
@@ -24,12 +41,25 @@ working_dir = os.path.dirname(working_dir)
 
 def parse_args():
     parser = argparse.ArgumentParser(
-            description='Collect a users comment history.')
-
-    parser.add_argument('-u', '--user', action='store', required=True,
-            help='redditor to collect')
+            description='Collect the comment and submission history of one or more users.')
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-u', '--user', action='store', nargs='+',
+            help='redditors to collect')
+    source.add_argument('-f', '--file', action='store',
+            help='file listing redditors to collect, one per line')
+    source.add_argument('-q', '--query', action='store',
+            help='SQL query whose first column names the redditors to collect')
     parser.add_argument('-t', '--table', action='store',
             default='user_comments')
+    parser.add_argument('-w', '--workers', action='store', type=int, default=4,
+            help='number of threads fetching histories concurrently')
+    parser.add_argument('-i', '--incremental', action='store_true',
+            help='stop at the newest post an earlier run collected for each redditor')
+    parser.add_argument('-s', '--submissions-table', action='store',
+            default='reddit_submissions')
+    parser.add_argument('--comments-only', action='store_true',
+            help="don't collect the redditors' submissions")
     parser.add_argument('-d', '--debug', action='store_true')
 
     args = parser.parse_args()
@@ -62,45 +92,244 @@ def _connect_to_db(dh_host, db_name, db_user, db_user_pass):
 
     return conn
 
-def _save_comments(comments):
-    """given a ListingGenerator of reddit comments, save to the database."""
+def _read_user_file(path):
+    """Read redditor names from a file, skipping blank lines and # comments."""
+    users = list()
+    with open(path, 'r') as fin:
+        for line in fin:
+            line = line.split('#')[0].strip()
+            if len(line) > 0:
+                users.append(line)
+    return users
+
+def _get_query_users(sql):
+    """Get redditor names from the first column of a query.
+
+    Note:
+    This function is NOT AT ALL SAFE for public use.
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        return [row[0] for row in cursor.fetchall() if row[0] is not None]
 
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _get_newest_posts(listing, users):
+    """Get the newest comment or submission collected from each redditor.
+
+    Only posts this script collected count: the same tables are filled by
+    the stream and subreddit collectors, and stopping at one of their rows
+    would skip the rest of a history never read.
+
+    Returns a dictionary mapping lower case redditor names to
+    (id, created_utc); users never collected are left out.
+    """
     cursor = None
     try:
         cursor = conn.cursor()
-        for comment in comments:
-            sql = '''
-                    INSERT INTO user_comments (
-                        id, author, subreddit, created, created_utc,
-                        author_flair_text, author_flair_css, link_permalink,
-                        body)
-                    VALUES (%(id)s, %(author)s, %(subreddit)s, %(created)s,
-                        %(created_utc)s, %(author_flair_text)s,
-                        %(author_flair_css)s, %(link_permalink)s, %(body)s)
-            '''
-
-            args = {
-                    'id':comment.id,
-                    'author':str(comment.author).replace('\x00', ''),
-                    'subreddit':str(comment.subreddit),
-                    'created':datetime.datetime.fromtimestamp(comment.created),
-                    'created_utc':datetime.datetime.fromtimestamp(comment.created_utc),
-                    'author_flair_text':comment.author_flair_text,
-                    'author_flair_css':comment.author_flair_css_class,
-                    'link_permalink':comment.link_permalink,
-                    'body':comment.body.replace('\x00', '')
-            }
-
-            cursor.execute(sql, args)
-
-        conn.commit()
+        cursor.execute('''
+            SELECT redditor, newest_id, newest_utc
+            FROM reddit_redditor_history
+            WHERE listing = %s AND redditor = ANY(%s);
+        ''', (listing, [user.lower() for user in users]))
+        return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _save_newest_post(user, listing, record):
+    """Record the newest post collected from a listing; does not commit."""
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO reddit_redditor_history
+                (redditor, listing, newest_id, newest_utc)
+            VALUES (%(user)s, %(listing)s, %(id)s, %(created_utc)s)
+            ON CONFLICT (redditor, listing) DO UPDATE
+                SET newest_id = EXCLUDED.newest_id,
+                    newest_utc = EXCLUDED.newest_utc,
+                    collected_at = now();
+        ''', {
+                'user': user.lower(),
+                'listing': listing,
+                'id': record['id'],
+                'created_utc': record['created_utc']})
 
-    except Exception as e:
-        logger.exception(e)
     finally:
-        if not cursor is None:
+        if cursor is not None:
             cursor.close()
 
+def _instantiate_reddit(config):
+    return praw.Reddit(
+            client_id = config['DEFAULT']['reddit_client_id'],
+            client_secret = config['DEFAULT']['reddit_client_secret'],
+            user_agent = config['DEFAULT']['reddit_user_agent'])
+
+def _comment_record(comment):
+    return {
+            'id':comment.id,
+            'author':str(comment.author).replace('\x00', ''),
+            'subreddit':str(comment.subreddit),
+            'created':datetime.datetime.fromtimestamp(comment.created),
+            'created_utc':datetime.datetime.fromtimestamp(comment.created_utc),
+            'author_flair_text':comment.author_flair_text,
+            'author_flair_css':comment.author_flair_css_class,
+            'link_permalink':comment.link_permalink,
+            'body':comment.body.replace('\x00', '')
+    }
+
+# Listings collected per redditor: columns written and record conversion
+LISTINGS = collections.OrderedDict([
+        ('comments', (bulk_writer.USER_COMMENT_COLUMNS, _comment_record)),
+        ('submissions', (bulk_writer.SUBMISSION_COLUMNS, harvest.submission_record))])
+
+# Most posts a listing request returns
+PAGE_SIZE = 100
+
+def _fetch_page(reddit, user, listing, after=None):
+    """Fetch one page of a redditor's comments or submissions; one request."""
+    return list(getattr(reddit.redditor(user), listing).new(
+            limit=PAGE_SIZE, params={'after': after}))
+
+def _fetch_history(reddit, budget, user, listing, newest=None):
+    """Fetch a redditor's comments or submissions, newest first.
+
+    Pages are requested one at a time through the budget, so each is paced
+    and retried on its own. Given the newest post already stored as
+    (id, created_utc) paging stops once it's reached, so only the listing
+    pages holding newer posts are requested. Posts made in the same second
+    as it are fetched again and skipped when written.
+    """
+    columns, make_record = LISTINGS[listing]
+    records = list()
+    after = None
+    while True:
+        page = budget.call(reddit, _fetch_page, reddit, user, listing, after)
+        for post in page:
+            record = make_record(post)
+            if newest is not None and (record['id'] == newest[0] or
+                    record['created_utc'] < newest[1]):
+                return records
+            records.append(record)
+        # A short page is the last; reddit stops listing after 1000 posts
+        if len(page) < PAGE_SIZE:
+            return records
+        after = page[-1].fullname
+
+def _fetch_worker(config, budget, pending, results, newest):
+    """Fetch (user, listing) histories from pending until it's empty.
+
+    Each history is put on results as (user, listing, records, None), or as
+    (user, listing, None, error) when it could not be fetched.
+    """
+    reddit = _instantiate_reddit(config)
+    while True:
+        try:
+            user, listing = pending.get_nowait()
+        except queue.Empty:
+            return
+
+        try:
+            records = _fetch_history(reddit, budget, user, listing,
+                    newest[listing].get(user.lower()))
+            results.put((user, listing, records, None))
+        except Exception as e:
+            logger.debug(e)
+            results.put((user, listing, None, e))
+
+def collect_histories(config, users, tables, workers=4, incremental=False):
+    """Fetch and save the comment and submission histories of many redditors.
+
+    Each listing of each redditor is a separate job, so a redditor's
+    comments and submissions are fetched concurrently by workers threads
+    under one rate budget; each history is bulk written as soon as it
+    arrives, along with its newest post. When incremental, each history is
+    fetched only as far back as the newest post an earlier run collected.
+
+    Arguments:
+        config      - parsed config holding the reddit credentials
+        users       - list of redditor names
+        tables      - dictionary mapping the LISTINGS to collect to their
+                      destination tables
+        workers     - number of threads fetching histories
+        incremental - stop at the newest post already collected
+
+    Returns a dictionary mapping each user to a dictionary mapping each
+    listing to (inserted, skipped, failed, error), error being None when
+    the history was saved.
+    """
+    newest = dict()
+    for listing, table in tables.items():
+        newest[listing] = dict()
+        if incremental:
+            newest[listing] = _get_newest_posts(listing, users)
+            logger.info('{} of {} redditors have collected {}'.format(
+                    len(newest[listing]), len(users), listing))
+
+    budget = scheduler.RateBudget()
+    pending = queue.Queue()
+    for user in users:
+        for listing in tables:
+            pending.put((user, listing))
+    results = queue.Queue()
+    n_jobs = pending.qsize()
+
+    for n in range(max(min(workers, n_jobs), 1)):
+        t = threading.Thread(
+                target=_fetch_worker,
+                args=(config, budget, pending, results, newest))
+        t.daemon = True
+        t.start()
+
+    report = collections.OrderedDict((user, dict()) for user in users)
+    for n in range(n_jobs):
+        user, listing, records, error = results.get()
+        counts = (0, 0, 0)
+        if error is None:
+            try:
+                counts = bulk_writer.write_rows(
+                        conn, tables[listing], LISTINGS[listing][0], records,
+                        commit=False)
+                # Records are newest first
+                if len(records) > 0:
+                    _save_newest_post(user, listing, records[0])
+                conn.commit()
+            except Exception as e:
+                logger.exception(e)
+                conn.rollback()
+                error = e
+        report[user][listing] = counts + (error,)
+
+        sys.stdout.write('\rCollected {} of {} histories | {}'.format(
+                n + 1, n_jobs, budget.describe()))
+        sys.stdout.flush()
+    sys.stdout.write('\n')
+
+    return report
+
+def _print_report(report):
+    failures = 0
+    for user in sorted(report, key=str.lower):
+        failed_user = False
+        for listing, (inserted, skipped, failed, error) in sorted(report[user].items()):
+            if error is None:
+                print(' {:<20} {:<11} {:>5} written, {:>5} skipped, {:>3} failed'.format(
+                        user, listing, inserted, skipped, failed))
+            else:
+                failed_user = True
+                print(' {:<20} {:<11} FAILED: {}'.format(user, listing, error))
+        if failed_user:
+            failures += 1
+    logger.info('{} of {} redditors collected'.format(
+            len(report) - failures, len(report)))
+    return failures
+
 if __name__ == '__main__':
 
     args = parse_args()
@@ -122,17 +351,24 @@ if __name__ == '__main__':
     if conn is None:
         sys.exit(1)
 
-    logger.debug('instantiate reddit object')
-    reddit = praw.Reddit(
-            client_id = config['DEFAULT']['reddit_client_id'],
-            client_secret = config['DEFAULT']['reddit_client_secret'],
-            user_agent = config['DEFAULT']['reddit_user_agent'])
-
+    failures = 0
     try:
-
-        logger.info('obtaining user history: {}'.format(args.user))
-        comments = reddit.redditor(args.user).comments.new(limit=None)
-        _save_comments(comments)
+        if args.file is not None:
+            users = _read_user_file(args.file)
+        elif args.query is not None:
+            users = _get_query_users(args.query)
+        else:
+            users = args.user
+        # Preserve order while dropping repeats
+        users = list(collections.OrderedDict.fromkeys(users))
+
+        logger.info('obtaining history of {} redditors'.format(len(users)))
+        tables = collections.OrderedDict([('comments', args.table)])
+        if not args.comments_only:
+            tables['submissions'] = args.submissions_table
+        report = collect_histories(config, users, tables, args.workers,
+                args.incremental)
+        failures = _print_report(report)
 
     except (KeyboardInterrupt, SystemExit):
         logger.info('exiting')
@@ -144,4 +380,4 @@ if __name__ == '__main__':
         if not conn is None:
             conn.close()
 
-    sys.exit(0)
+    sys.exit(1 if failures > 0 else 0)
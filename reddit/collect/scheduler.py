@@ -0,0 +1,172 @@
+#
+# Schedule reddit API requests against the rate limit.
+#
+# Reddit reports what is left of the allowance in the x-ratelimit-remaining,
+# x-ratelimit-used and x-ratelimit-reset headers of every response. Each PRAW
+# instance only paces its own requests, so collectors running several
+# instances (one per worker thread) draw from a single RateBudget which spreads
+# the remaining requests evenly over what is left of the window. Requests
+# throttled with a 429, failing with a 5xx or failing to connect are retried
+# after a jittered exponential backoff which pauses every thread sharing the
+# budget.
+#
+
+import logging
+import random
+import threading
+import time
+
+import prawcore
+
+logger = logging.getLogger('main')
+
+# Reddit's rate limit windows are ten minutes long
+WINDOW_SECONDS = 600
+
+def is_retryable(e):
+    """Whether an exception from PRAW is worth retrying after a backoff."""
+    if isinstance(e, prawcore.exceptions.RequestException):
+        return True
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    return status is not None and (status == 429 or status >= 500)
+
+class RateBudget(object):
+    """A request budget shared by every thread of a collector.
+
+    Arguments:
+        requests_per_minute - pace used until the API has reported its limits
+        backoff_base        - seconds of the first backoff
+        backoff_cap         - longest single backoff in seconds
+        max_retries         - attempts before a failing request is given up
+        max_per_minute      - cap on the pace whatever the API allows, leaving
+                              the rest of the allowance to other collectors
+    """
+
+    def __init__(self, requests_per_minute=60, backoff_base=1, backoff_cap=300,
+            max_retries=8, max_per_minute=None):
+        self._lock = threading.Lock()
+        self._default_interval = 60.0 / requests_per_minute
+        self._min_interval = 0.0
+        if max_per_minute is not None:
+            self._min_interval = 60.0 / max_per_minute
+        self._next_request = time.time()
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_retries = max_retries
+        self.remaining = None
+        self.used = None
+        self.reset_at = None
+        self.requests = 0
+        self.retries = 0
+
+    def _interval(self, now):
+        """Seconds to leave between requests given what's left of the window."""
+        if self.remaining is None or self.reset_at is None or now >= self.reset_at:
+            interval = self._default_interval
+        elif self.remaining < 1:
+            interval = self.reset_at - now
+        else:
+            interval = (self.reset_at - now) / self.remaining
+        return max(interval, self._min_interval)
+
+    def _reserve(self):
+        """Claim the next request slot; returns seconds to wait for it."""
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_request)
+            self._next_request = start + self._interval(start)
+            if self.remaining is not None:
+                self.remaining = max(self.remaining - 1, 0)
+            self.requests += 1
+        return start - now
+
+    def acquire(self):
+        """Block until the caller may make one API request."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, reddit):
+        """Refresh the budget from the rate limit headers PRAW last saw.
+
+        Arguments:
+            reddit  - PRAW object whose last response carried the headers
+        """
+        limiter = reddit._core._rate_limiter
+        if limiter.remaining is None:
+            return
+
+        # Older prawcore keeps the reset time; newer releases only keep the
+        #   remaining count, so fall back on the end of the current window.
+        reset_at = getattr(limiter, 'reset_timestamp', None)
+        if reset_at is None:
+            now = time.time()
+            reset_at = now - now % WINDOW_SECONDS + WINDOW_SECONDS
+
+        with self._lock:
+            self.remaining = limiter.remaining
+            self.used = limiter.used
+            self.reset_at = reset_at
+
+    def backoff(self, attempt):
+        """Pause every thread sharing the budget after a failed request.
+
+        The pause grows exponentially with the attempt number, up to
+        backoff_cap, and is drawn at random below that bound so threads that
+        failed together don't retry together.
+
+        Returns the number of seconds paused.
+        """
+        delay = self._backoff_delay(attempt)
+        time.sleep(delay)
+        return delay
+
+    def _backoff_delay(self, attempt):
+        """Push back the next request slot; returns seconds to pause."""
+        delay = random.uniform(0, min(self.backoff_cap,
+                self.backoff_base * 2 ** attempt))
+        with self._lock:
+            self._next_request = max(self._next_request, time.time() + delay)
+            self.retries += 1
+        return delay
+
+    def call(self, reddit, function, *args, **kwargs):
+        """Make an API request paced by the budget, retrying on failure.
+
+        Arguments:
+            reddit      - PRAW object the request is made through
+            function    - callable making exactly one request
+            args/kwargs - passed to function
+
+        Returns whatever function returns; raises once max_retries is spent.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = function(*args, **kwargs)
+                self.update(reddit)
+                return result
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                delay = self.backoff(attempt)
+                logger.warning('{}; retry {} of {} after {:.1f}s'.format(
+                        e, attempt, self.max_retries, delay))
+
+    def utilization(self):
+        """Fraction of the current window's allowance already used, if known."""
+        with self._lock:
+            if self.remaining is None or self.used is None:
+                return None
+            total = self.used + self.remaining
+            return float(self.used) / total if total > 0 else 1.0
+
+    def describe(self):
+        """Short summary of the budget for progress output."""
+        utilization = self.utilization()
+        if utilization is None:
+            return 'api {} requests'.format(self.requests)
+        return 'api {:.0%} of window used, {} left'.format(
+                utilization, self.remaining)
@@ -0,0 +1,8 @@
+-- Add the unique id constraint to a comment or submission table created before
+-- the bulk writer deduplicated in the database. Replace subreddit with the
+-- table name. Duplicate rows collected before the constraint are removed first.
+DELETE FROM subreddit a
+    USING subreddit b
+    WHERE a.id = b.id
+        AND a.ctid < b.ctid;
+ALTER TABLE subreddit ADD CONSTRAINT subreddit_id_key UNIQUE (id);
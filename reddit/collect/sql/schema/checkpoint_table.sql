@@ -0,0 +1,28 @@
+-- Checkpoints for subreddit_comments.py backfills. A job is a subreddit and
+-- date range; once its submission ids are harvested they're recorded here and
+-- marked completed as their comments are written.
+CREATE TABLE reddit_checkpoint_jobs (
+    subreddit character varying(50) NOT NULL,
+    start_date timestamp without time zone NOT NULL,
+    end_date timestamp without time zone NOT NULL,
+    harvested_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (subreddit, start_date, end_date)
+);
+CREATE TABLE reddit_checkpoint_submissions (
+    subreddit character varying(50) NOT NULL,
+    start_date timestamp without time zone NOT NULL,
+    end_date timestamp without time zone NOT NULL,
+    submission_id character varying(15) NOT NULL,
+    completed boolean NOT NULL DEFAULT false,
+    PRIMARY KEY (subreddit, start_date, end_date, submission_id)
+);
+-- How far an id range walk (subreddit_comments.py --by-id) has got; every
+-- submission id below next_id, read as base 36, has been looked up.
+CREATE TABLE reddit_checkpoint_ranges (
+    subreddit character varying(50) NOT NULL,
+    start_date timestamp without time zone NOT NULL,
+    end_date timestamp without time zone NOT NULL,
+    next_id bigint NOT NULL,
+    saved_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (subreddit, start_date, end_date)
+);
@@ -0,0 +1,20 @@
+-- Edits and deletions comment_revalidate.py finds in stored comments. The
+-- comment tables keep the body as first collected; each change found later
+-- is recorded here with the body before and after it.
+CREATE TABLE reddit_comment_history (
+    table_name character varying(50) NOT NULL,
+    id character varying(15) NOT NULL,
+    change character varying(10) NOT NULL,
+    old_body character varying(50000),
+    new_body character varying(50000),
+    detected_at timestamp without time zone DEFAULT now()
+);
+CREATE INDEX reddit_comment_history_id_idx
+    ON reddit_comment_history (table_name, id, detected_at);
+-- When comment_revalidate.py last re-fetched each stored comment
+CREATE TABLE reddit_comment_checks (
+    table_name character varying(50) NOT NULL,
+    id character varying(15) NOT NULL,
+    checked_at timestamp without time zone NOT NULL,
+    PRIMARY KEY (table_name, id)
+);
@@ -11,6 +11,7 @@ CREATE TABLE subreddit (
     author_flair_text character varying(100),
     author_flair_css character varying(100),
     edited boolean,
-    body character varying(50000)
+    body character varying(50000),
+    CONSTRAINT subreddit_id_key UNIQUE (id)
 );
 INSERT INTO reddit_subreddits (subreddit) VALUES ('subreddit');
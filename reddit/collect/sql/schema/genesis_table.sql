@@ -0,0 +1,7 @@
+-- Caches the first still accessible submission of each subreddit so backfills
+-- don't have to search for it again
+CREATE TABLE reddit_subreddit_genesis (
+    subreddit character varying(50) NOT NULL PRIMARY KEY,
+    origin_epoch double precision NOT NULL,
+    found_at timestamp without time zone DEFAULT now()
+);
@@ -0,0 +1,8 @@
+-- Rows the bulk writer could not load, kept for inspection and replay
+CREATE TABLE reddit_quarantine (
+    table_name character varying(50),
+    id character varying(15),
+    record text,
+    error text,
+    quarantined_at timestamp without time zone DEFAULT now()
+);
@@ -0,0 +1,11 @@
+-- The newest post redditor_history.py has collected from each listing of a
+-- redditor. With --incremental paging stops there; rows the stream or the
+-- subreddit collectors wrote say nothing about how far a history was read.
+CREATE TABLE reddit_redditor_history (
+    redditor character varying(50) NOT NULL,
+    listing character varying(15) NOT NULL,
+    newest_id character varying(15) NOT NULL,
+    newest_utc timestamp without time zone NOT NULL,
+    collected_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (redditor, listing)
+);
@@ -0,0 +1,7 @@
+-- When submission_refresh.py last refreshed the score and comment count of a
+-- submission in reddit_submissions
+CREATE TABLE reddit_submission_refresh (
+    id character varying(15) NOT NULL PRIMARY KEY,
+    refreshed_at timestamp without time zone NOT NULL,
+    refreshes integer NOT NULL DEFAULT 0
+);
@@ -16,5 +16,6 @@ CREATE TABLE reddit_submissions (
     permalink character varying(100),
     url character varying(1000),
     selftext character varying(40000),
-    title character varying(1000)
+    title character varying(1000),
+    CONSTRAINT reddit_submissions_id_key UNIQUE (id)
 );
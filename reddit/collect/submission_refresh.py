@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Refresh the score and comment counts of recently created submissions.
+#
+# Submissions are collected once, so their score, ups, downs and num_comments
+# are frozen at whatever they were then. This re-fetches submissions younger
+# than --max-age by id, 100 to a request, on a decaying schedule: a submission
+# is due again once a fraction (--factor) of its age has passed since its last
+# refresh, so young submissions are refreshed often and old ones rarely. Only
+# those columns are updated, and only where they changed.
+#
+# Refresh times are kept in reddit_submission_refresh; see
+# sql/schema/refresh_table.sql.
+#
+
+import argparse
+import configparser
+import datetime
+import logging
+import os
+import sys
+import time
+
+import praw
+import psycopg2
+from psycopg2.extras import execute_values
+
+import bulk_writer
+import scheduler
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logger = logging.getLogger('main')
+
+working_dir = os.path.realpath(__file__)
+working_dir = os.path.dirname(working_dir)
+
+# Most ids reddit's info endpoint takes in one request
+INFO_LIMIT = 100
+
+def _connect_to_db(dh_host, db_name, db_user, db_user_pass):
+    conn = None
+    cursor = None
+
+    connstr = \
+            "host={db_host} " + \
+            "dbname='{db_name}' " + \
+            "user='{db_user}' " + \
+            "password='{db_user_pass}'"
+    connstr = connstr.format(
+                db_host=db_host,
+                db_name=db_name,
+                db_user=db_user,
+                db_user_pass=db_user_pass)
+    try:
+        conn = psycopg2.connect(connstr)
+
+    except Exception as e:
+        logger.exception(e)
+
+    return conn
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Refresh scores and comment counts of recent submissions.')
+
+    parser.add_argument('-r', '--subreddit', action='store', nargs='+',
+            help='only refresh submissions to these subreddits')
+    parser.add_argument('-a', '--max-age', action='store', type=float,
+            default=72, help='refresh submissions up to this many hours old')
+    parser.add_argument('-f', '--factor', action='store', type=float,
+            default=0.1,
+            help='refresh again once this fraction of its age has passed')
+    parser.add_argument('-m', '--min-interval', action='store', type=float,
+            default=10, help='least minutes between refreshes of a submission')
+    parser.add_argument('-l', '--loop', action='store_true',
+            help='keep refreshing as submissions fall due instead of exiting')
+    parser.add_argument('-d', '--debug', action='store_true')
+
+    args = parser.parse_args()
+    return args
+
+def parse_config():
+    config = configparser.ConfigParser()
+    config.read_file(open(os.path.join(working_dir, '../config.conf')))
+    return config
+
+def _get_due_submissions(subreddits, max_age, factor, min_interval):
+    """Get ids of submissions due a refresh, youngest first.
+
+    Arguments:
+        subreddits      - list of subreddit names, or None for every subreddit
+        max_age         - timedelta; older submissions are left alone
+        factor          - fraction of a submission's age between refreshes
+        min_interval    - timedelta; least time between refreshes
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+
+        # created_utc is stored in local time, as is now
+        now = datetime.datetime.now()
+        sql = '''
+            SELECT s.id
+            FROM reddit_submissions s
+            LEFT JOIN reddit_submission_refresh r ON r.id = s.id
+            WHERE s.created_utc > %(oldest)s
+                AND (r.refreshed_at IS NULL
+                    OR r.refreshed_at < %(now)s - GREATEST(
+                        %(min_interval)s, (%(now)s - s.created_utc) * %(factor)s))
+        '''
+        if subreddits is not None:
+            sql += '''
+                AND lower(s.subreddit) = ANY(%(subreddits)s)
+            '''
+        sql += '''
+            ORDER BY s.created_utc DESC;
+        '''
+        cursor.execute(sql, {
+                'now': now,
+                'oldest': now - max_age,
+                'min_interval': min_interval,
+                'factor': factor,
+                'subreddits': [name.lower() for name in subreddits or list()]})
+        return [row[0] for row in cursor.fetchall()]
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _mark_refreshed(ids):
+    """Record the refresh time of submissions; does not commit."""
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        execute_values(cursor, '''
+            INSERT INTO reddit_submission_refresh (id, refreshed_at, refreshes)
+            VALUES %s
+            ON CONFLICT (id) DO UPDATE
+            SET refreshed_at = EXCLUDED.refreshed_at,
+                refreshes = reddit_submission_refresh.refreshes + 1;
+        ''', [(s_id, datetime.datetime.now(), 1) for s_id in ids])
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _refresh_record(submission):
+    return {
+            'id': submission.id,
+            'score': submission.score,
+            'ups': submission.ups,
+            'downs': submission.downs,
+            'num_comments': submission.num_comments
+    }
+
+def refresh_submissions(reddit, budget, ids):
+    """Re-fetch submissions by id and update their changed counts.
+
+    Each request looks up INFO_LIMIT submissions and is committed along with
+    their refresh times. Submissions reddit no longer returns are marked
+    refreshed too so they're not asked for again until next due.
+
+    Returns updated, unchanged
+    """
+    updated = 0
+    unchanged = 0
+    for n in range(0, len(ids), INFO_LIMIT):
+        chunk = ids[n:n + INFO_LIMIT]
+        submissions = budget.call(reddit, lambda: list(reddit.info(
+                fullnames=['t3_' + s_id for s_id in chunk])))
+
+        counts = bulk_writer.update_rows(conn, 'reddit_submissions',
+                bulk_writer.SUBMISSION_REFRESH_COLUMNS,
+                [_refresh_record(submission) for submission in submissions],
+                commit=False)
+        _mark_refreshed(chunk)
+        conn.commit()
+
+        updated += counts[0]
+        unchanged += counts[1]
+        sys.stdout.write('\rRefreshed {} of {} submissions ({} changed, {})'.format(
+                min(n + INFO_LIMIT, len(ids)), len(ids), updated,
+                budget.describe()))
+        sys.stdout.flush()
+    if len(ids) > 0:
+        print()
+
+    return updated, unchanged
+
+if __name__ == '__main__':
+
+    args = parse_args()
+    config = parse_config()
+
+    if args.debug:
+        logger.level = logging.DEBUG
+
+    db_host = config['DEFAULT']['db_host']
+    db_name = config['DEFAULT']['db_name']
+    db_user = config['DEFAULT']['db_user']
+    db_pass = config['DEFAULT']['db_pass']
+
+    logger.debug('instantiate reddit object')
+    reddit = praw.Reddit(
+            client_id = config['DEFAULT']['reddit_client_id'],
+            client_secret = config['DEFAULT']['reddit_client_secret'],
+            user_agent = config['DEFAULT']['reddit_user_agent'])
+    budget = scheduler.RateBudget()
+
+    global conn
+    conn = None
+    try:
+        logger.debug('connect to database')
+        conn = _connect_to_db(db_host, db_name, db_user, db_pass)
+        if conn is None:
+            sys.exit(1)
+
+        max_age = datetime.timedelta(hours=args.max_age)
+        min_interval = datetime.timedelta(minutes=args.min_interval)
+        while True:
+            logger.debug('get submissions due a refresh')
+            ids = _get_due_submissions(args.subreddit, max_age, args.factor,
+                    min_interval)
+            logger.info('{} submissions due a refresh'.format(len(ids)))
+
+            updated, unchanged = refresh_submissions(reddit, budget, ids)
+            logger.info('{} submissions updated, {} unchanged'.format(
+                    updated, unchanged))
+
+            if not args.loop:
+                break
+            time.sleep(min_interval.total_seconds())
+
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('exiting')
+
+    except Exception as e:
+        logger.exception(e)
+
+    finally:
+        if not conn is None:
+            conn.close()
+
+    sys.exit(0)
@@ -8,15 +8,23 @@
 
 import argparse
 import configparser
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 import os
+import queue
 import sys
+import threading
 import time
 
 import praw
 import psycopg2
 
+import bulk_writer
+import checkpoint
+import harvest
+import id_range
+import scheduler
+
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger('main')
 
@@ -58,7 +66,24 @@ def parse_args():
     parser.add_argument('-t', '--table', action='store',
             default='{subreddit}')
     parser.add_argument('-u', '--unsafe', action='store_true',
-            help='do not pull a list of comment ids already in the destination table')
+            help='skip deduplication and COPY straight into the destination table')
+    parser.add_argument('--restart', action='store_true',
+            help='discard any checkpoint for this subreddit and date range')
+    parser.add_argument('-w', '--workers', action='store', type=int, default=1,
+            help='number of threads harvesting and fetching comment trees concurrently')
+    parser.add_argument('-i', '--by-id', action='store_true',
+            help='find submissions by walking their id range instead of searching')
+    parser.add_argument('-e', '--expand', action='store_true',
+            help='resolve collapsed "load more comments" branches in batches')
+    parser.add_argument('--queue-size', action='store', type=int, default=20000,
+            help='comments held in memory between fetchers and the writer')
+    parser.add_argument('--flush-rows', action='store', type=int, default=5000,
+            help='write to the database every n comments')
+    parser.add_argument('--flush-seconds', action='store', type=float, default=30,
+            help='write to the database at least every n seconds')
+    parser.add_argument('--async', action='store_true', dest='use_async',
+            help='fetch with asyncpraw and write with asyncpg; -w sets the '
+                 'number of concurrent fetches')
     parser.add_argument('-d', '--debug', action='store_true')
 
     args = parser.parse_args()
@@ -76,6 +101,9 @@ def parse_args():
     args.daterange[0] = datetime.strptime(args.daterange[0], '%Y%m%d%H%M%S')
     args.daterange[1] = datetime.strptime(args.daterange[1], '%Y%m%d%H%M%S')
 
+    if args.use_async and args.expand:
+        parser.error('--expand is not supported with --async')
+
     return args
 
 def parse_config():
@@ -86,280 +114,422 @@ def parse_config():
 def get_epoch(dt):
     return (dt - epoch).total_seconds()
 
-def search_subreddit(subreddit, start_epoch, end_epoch):
-    """Return a list of submissions between start and end epoch.
-
-    Arguments:
-        subreddit   - praw subreddit object
-        start_epoch - float
-        end_epoch   - float
-    """
-
-    query = 'timestamp:{start_epoch}..{end_epoch}'.format(
-            start_epoch=int(start_epoch), end_epoch=int(end_epoch))
-    submissions = subreddit.search(
-            query,
-            sort='new',
-            syntax='cloudsearch')
-
-    return list(submissions)
-
-def get_genesis_post(subreddit, start_epoch, end_epoch, start_date, end_date):
-    '''Walk subscriptions backwards; find the subreddit's first post.
-
-    The origin submission for a subreddit would be the very first, still
-    accessible, submission. Alternatively, this function returns the first
-    submission within the specified date range.
+def get_submission_ids(config, subreddit_name, start_epoch, end_epoch, workers=1):
+    """Return the ids of submissions created between start and end epoch.
 
-    Arguments:
-        subreddit   - PRAW object
-        start_date  - datetime
-        end_date    - datetime
-    '''
-    origin = None
-
-    # Find the origin year
-    while True:
-        start_epoch = get_epoch(start_date)
-        end_epoch = get_epoch(end_date)
-        submissions = search_subreddit(subreddit, start_epoch, end_epoch)
-        if len(submissions) == 0:
-            end_date = end_date.replace(year=end_date.year + 1)
-            break
-        sys.stdout.write('\rsearching genesis post for {} in {}'.format(
-                subreddit, end_date))
-        sys.stdout.flush()
-        end_date = end_date.replace(year=end_date.year - 1)
-
-    # Reset end_epoch to last year
-    end_epoch = get_epoch(end_date)
-
-    # Now iterate months until we find the origin month
-    while True:
-        start_epoch = get_epoch(start_date)
-        end_epoch = get_epoch(end_date)
-        submissions = search_subreddit(subreddit, start_epoch, end_epoch)
-        last_month = end_date
-        if len(submissions) == 0:
-            end_date = end_date
-            break
-        origin = submissions[-1].created
-        sys.stdout.write('\rsearching genesis post for {} in {}'.format(
-                subreddit, end_date))
-        sys.stdout.flush()
-        end_date = end_date.replace(day=end_date.day - end_date.day + 1)
-        end_date += timedelta(days=-1)
+    See harvest.harvest_submissions; the date range is sharded and searched
+    by workers threads sharing one request budget.
 
-    sys.stdout.write('\rfound {} origin submission at {}; epoch is {}\n'.format(
-            subreddit, end_date, origin))
-    sys.stdout.flush()
-    return origin
+    Returns None when windows of the range could not be searched.
+    """
+    return harvest.harvest_submissions(
+            lambda: _instantiate_reddit(config).subreddit(subreddit_name),
+            start_epoch, end_epoch, workers, scheduler.RateBudget())
 
-def get_submission_ids(subreddit, start_epoch, end_epoch, end_date):
-    i = 0
-    ids = list()
-
-    end_epoch_saved =  None
-    while True:
-
-        # We request all submissions within our start and end date range
-        submissions = search_subreddit(subreddit, start_epoch, end_epoch)
-        if len(submissions) == 0:
-            sys.stdout.write('\n')
-            sys.stdout.flush()
-            break
-
-        # A limited number of the newest submissions are returned
-        #   so get the end_epoch of the last received submission and update our
-        #   date range.
-        end_epoch = submissions[-1].created - 1
-
-        if i == 0:
-            end_epoch_saved = end_epoch
-        # Note: are we working with created, rather than created_utc? We might
-        #   want to fix that sometime, but it works for now so who cares.
-        end_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_epoch))
-
-        # How many we've done / how manty to do
-        now = get_epoch(datetime.now())
-        percentage = (end_epoch_saved - end_epoch) / (end_epoch_saved - start_epoch) * 100
-        sys.stdout.write(
-                '\rharvest {} submission ids {:00.2f}% complete | '.format(subreddit, percentage) + \
-                'date: {} end_epoc: {}'.format(end_date, end_epoch))
-        sys.stdout.flush()
+def get_submission_ids_by_range(config, job, subreddit_name, start_epoch,
+        end_epoch, workers=1):
+    """Return the ids of submissions created between start and end epoch.
 
-        for s in submissions:
-            ids.append(s.id)
+    Walks the submission ids between those estimated for start and end epoch
+    by batched by-id lookups rather than searching; see id_range.walk_range.
+    The walk is checkpointed under job, so an interrupted walk resumes.
 
-        i += 1
+    Returns None when blocks of ids could not be looked up; the walk has to
+    be resumed before the job's submissions are known.
+    """
+    budget = scheduler.RateBudget()
+    reddit = _instantiate_reddit(config)
+
+    # A resumed walk starts from its saved position
+    start_id = checkpoint.load_position(conn, job)
+    if start_id is None:
+        logger.debug('estimate first id')
+        start_id = id_range.estimate_id(reddit, budget, start_epoch)
+    logger.debug('estimate last id')
+    end_id = id_range.estimate_id(reddit, budget, end_epoch) + id_range.INFO_LIMIT
+    logger.info('walking submission ids t3_{} to t3_{}'.format(
+            id_range.to_base36(start_id), id_range.to_base36(end_id)))
+
+    id_range.walk_range(conn, job, lambda: _instantiate_reddit(config),
+            {subreddit_name.lower()}, start_epoch, end_epoch, start_id, end_id,
+            workers, budget)
+    return checkpoint.load_job(conn, job)
+
+def _dump_to_database(full_comments, table, unsafe=False, job=None,
+        completed_ids=()):
+    """Given a list of comments (in dictionary form) dump them to the database.
 
-    return ids
+    Comments are bulk written through COPY and deduplicated by the database
+    against the destination table; see bulk_writer.write_rows. Unsafe skips
+    the deduplicating merge and COPYs straight into the destination.
 
-def _get_last_n_comment_ids(table, n):
-    """Get the last n comment ids of a subreddit from our database.
+    When a checkpointed job is given, completed_ids are marked as written in
+    the same transaction as the comments.
 
-    Note:
-    This function is in no way safe for public use!
+    Returns inserted_comments, skipped_comments, failed_comments, or None
+    when the batch was rolled back.
     """
 
-    cursor = None
     try:
-        cursor = conn.cursor()
-
-        sql = '''
-            SELECT id
-            FROM {table}
-            ORDER BY created_utc DESC
-            LIMIT {n};
-        '''.format(table = table, n = n)
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-
-        ids = dict()
-        for row in rows:
-            ids[row[0]] = None
-
-        return ids
+        counts = bulk_writer.write_rows(
+                conn, table, bulk_writer.COMMENT_COLUMNS, full_comments,
+                dedupe=not unsafe, commit=False)
+        if job is not None:
+            checkpoint.mark_completed(conn, job, completed_ids)
+        conn.commit()
+        return counts
 
     except Exception as e:
-        print('\nan error occurred obtaining existing ids: {}'.format(e))
+        logger.exception(e)
+        conn.rollback()
+        return None
 
-    finally:
-        if cursor is not None:
-            cursor.close()
+def _instantiate_reddit(config):
+    return praw.Reddit(
+            client_id = config['DEFAULT']['reddit_client_id'],
+            client_secret = config['DEFAULT']['reddit_client_secret'],
+            user_agent = config['DEFAULT']['reddit_user_agent'])
 
-def _dump_to_database(full_comments, table):
-    """Given a list of comments (in dictionary form) dump them to the database.
+def _load_submission(reddit, s_id):
+    """Fetch a submission along with its comment forest in one request."""
+    submission = praw.models.Submission(reddit, id=s_id)
+    # Comments are fetched lazily; touching them makes the request here
+    submission.comments
+    return submission
 
-    safe or unsafe, pulls a list of existing comment ID's from the destination
-    table and skips comments based on what's already there.
+def _fetch_comments(submission, more_ids=None):
+    """Yield the comments of a submission as dictionaries.
 
-    Returns inserted_comments, skipped_comments, failed_comments
+    Collapsed "load more comments" branches are discarded unless more_ids is
+    a list, in which case their child ids are appended to it for expansion.
+    """
+    if more_ids is None:
+        submission.comments.replace_more(limit=0)
+    for comment in submission.comments.list():
+        if isinstance(comment, praw.models.MoreComments):
+            more_ids.extend(comment.children)
+            continue
+        yield harvest.comment_record(comment)
+
+def _put(results, item, stop):
+    """Put an item on the bounded results queue unless we're stopping.
+
+    Blocks while the queue is full, which is what holds fetchers back when
+    the writer falls behind.
+    """
+    while not stop.is_set():
+        try:
+            results.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _fetch_worker(config, budget, pending, results, stop, expander=None):
+    """Fetch comment trees for submission ids until none are pending.
+
+    Every worker has its own PRAW session but draws from the shared budget.
+    Each comment is handed to the writer as ('comment', record) followed by
+    ('done', id) once the whole submission has been queued, or ('failed', id)
+    if it couldn't be fetched so it's left for a resumed job to retry. With
+    an expander the collapsed branches of the submission are handed to it
+    instead, and it reports the submission done once they're resolved.
+    """
+    reddit = _instantiate_reddit(config)
+    while not stop.is_set():
+        try:
+            s_id = pending.get_nowait()
+        except queue.Empty:
+            return
+
+        more_ids = list() if expander is not None else None
+        n = 0
+        try:
+            submission = budget.call(reddit, _load_submission, reddit, s_id)
+            for record in _fetch_comments(submission, more_ids):
+                if not _put(results, ('comment', record), stop):
+                    return
+                n += 1
+        except Exception as e:
+            logger.exception(e)
+            logger.error('could not fetch submission {}'.format(s_id))
+            _put(results, ('failed', s_id), stop)
+            continue
+
+        if expander is not None:
+            expander.add(s_id, n, submission.num_comments, more_ids)
+        else:
+            _put(results, ('done', s_id), stop)
+
+class MoreCommentsExpander(threading.Thread):
+    """Resolve collapsed comment branches of many submissions in batches.
+
+    Fetchers hand over the child ids of every MoreComments they meet. Ids
+    from all submissions are pooled and looked up INFO_BATCH at a time, the
+    most the by-id endpoint accepts, rather than expanding each tree with a
+    request per branch. A submission is reported done once all of its ids are
+    resolved, along with how much of its num_comments was collected, or
+    failed if a lookup holding some of its ids raised.
+
+    Only the ids listed by a collapsed branch are recovered. Deeper "continue
+    this thread" stubs list none and remain missing; the coverage statistics
+    show what's left.
     """
 
-    cursor = None
-    try:
-
-        existing_ids = _get_last_n_comment_ids(table, 10000000)
-        skipped_comments = 0
-        new_comments = list()
-        for c in full_comments:
-            if c['id'] in existing_ids:
-                skipped_comments += 1
-                continue
-            new_comments.append(c)
-
-        cursor = conn.cursor()
-
-        sql = list()
-        inserted_comments = 0
-        failed_comments = 0
-        sql = None
-        for comment in new_comments:
-            sql = '''
-                    INSERT INTO {table} (
-                        id, parent_id, link_id, author, created, created_utc,
-                        author_flair_text, author_flair_css, edited, body)
-                    VALUES (%(id)s, %(parent_id)s, %(link_id)s, %(author)s, %(created)s,
-                        %(created_utc)s, %(author_flair_text)s, %(author_flair_css)s,
-                        %(edited)s, %(body)s);
-            '''.format(table=table)
+    INFO_BATCH = 100
+
+    def __init__(self, config, budget, results, stop, fetchers, wait=2):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.config = config
+        self.budget = budget
+        self.results = results
+        self.stop = stop
+        self.fetchers = fetchers
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.queued = list()
+        self.remaining = dict()
+        self.stats = dict()
+        self.failed = set()
+        self.requests = 0
+
+    def add(self, s_id, tree_count, num_comments, more_ids):
+        """Queue the collapsed child ids of a fetched submission."""
+        with self.lock:
+            self.stats[s_id] = {
+                    'tree': tree_count,
+                    'expanded': 0,
+                    'num_comments': num_comments}
+            self.remaining[s_id] = set(more_ids)
+            self.queued.extend((s_id, c_id) for c_id in more_ids)
+        if len(more_ids) == 0:
+            self._done(s_id)
+
+    def _done(self, s_id):
+        with self.lock:
+            self.remaining.pop(s_id, None)
+            stats = self.stats.pop(s_id)
+            failed = s_id in self.failed
+            self.failed.discard(s_id)
+        collected = stats['tree'] + stats['expanded']
+        coverage = float(collected) / stats['num_comments'] \
+                if stats['num_comments'] else 1.0
+        logger.info('{}: {} comments in tree + {} expanded of {} ({:.1%})'.format(
+                s_id, stats['tree'], stats['expanded'], stats['num_comments'],
+                coverage))
+        _put(self.results, ('failed' if failed else 'done', s_id), self.stop)
+
+    def _next_batch(self):
+        """Wait for a full batch, or settle for less once fetching slows."""
+        waited = 0
+        while not self.stop.is_set():
+            with self.lock:
+                n_queued = len(self.queued)
+            fetching = any(t.is_alive() for t in self.fetchers)
+            if n_queued >= self.INFO_BATCH or \
+                    (n_queued > 0 and (waited >= self.wait or not fetching)):
+                break
+            if n_queued == 0 and not fetching:
+                return None
+            time.sleep(0.1)
+            waited += 0.1
+
+        with self.lock:
+            batch = self.queued[:self.INFO_BATCH]
+            self.queued = self.queued[self.INFO_BATCH:]
+        return batch
+
+    def run(self):
+        reddit = _instantiate_reddit(self.config)
+        while not self.stop.is_set():
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            owners = dict((c_id, s_id) for s_id, c_id in batch)
             try:
-                cursor.execute(sql, comment)
-                inserted_comments += 1
+                fullnames = ['t1_' + c_id for c_id in owners]
+                comments = self.budget.call(
+                        reddit, lambda: list(reddit.info(fullnames=fullnames)))
+                self.requests += 1
+                for comment in comments:
+                    if not _put(self.results,
+                            ('comment', harvest.comment_record(comment)), self.stop):
+                        return
+                    with self.lock:
+                        self.stats[owners[comment.id]]['expanded'] += 1
             except Exception as e:
                 logger.exception(e)
-                logger.error(comment)
-                failed_comments += 1
-
-        conn.commit()
-        return inserted_comments, skipped_comments, failed_comments
+                logger.error('could not expand {} comments'.format(len(owners)))
+                # Leave their submissions for a resumed job to retry
+                with self.lock:
+                    self.failed.update(owners.values())
+
+            # Ids the lookup didn't return are gone; don't wait on them
+            finished = list()
+            with self.lock:
+                for c_id, s_id in owners.items():
+                    self.remaining[s_id].discard(c_id)
+                    if len(self.remaining[s_id]) == 0:
+                        finished.append(s_id)
+            for s_id in set(finished):
+                self._done(s_id)
+
+def _flush(full_comments, destination_table, unsafe, s_id, job=None,
+        completed_ids=(), lost_ids=None):
+    """Write a batch of comments, marking completed_ids done alongside them.
+
+    Submissions with comments in lost_ids, a set of ids whose comments were
+    in a batch that failed, are never marked completed. A failed batch adds
+    the submissions of its comments to lost_ids so a resumed job retries them.
+    """
+    sys.stdout.write(' [...]')
+    sys.stdout.flush()
+    if lost_ids is not None:
+        completed_ids = [c for c in completed_ids if c not in lost_ids]
+    counts = _dump_to_database(full_comments, destination_table, unsafe, job,
+            completed_ids)
+    if counts is None:
+        if lost_ids is not None:
+            lost_ids.update(c['link_id'][3:] for c in full_comments)
+        sys.stdout.write(' could not write {} records; their submissions are '
+                'left for a resumed job\n'.format(len(full_comments)))
+        sys.stdout.flush()
+        return
+    inserted_comments, skipped_comments, failed_comments = counts
+    sys.stdout.write(' {} records written, {} skipped, {} failed; (last id {}) \n'.format(
+            inserted_comments,
+            skipped_comments,
+            failed_comments,
+            s_id.strip() if s_id is not None else None))
+    sys.stdout.flush()
 
-    except Exception as e:
-        logger.exception(e)
+def collect_comments(config, subreddit_name, ids, destination_table,
+        unsafe=False, workers=1, queue_size=20000, flush_rows=5000,
+        flush_seconds=30, job=None, expand=False):
+    """Fetch the comments of every submission and write them to the database.
 
-    finally:
-        if cursor is not None:
-            cursor.close()
+    Comment trees are fetched by a pool of worker threads drawing on one
+    shared request budget. Fetchers push comments onto a bounded queue which
+    this thread, the only one writing to the database, drains and flushes
+    every flush_rows comments or flush_seconds seconds, whichever comes first.
+    When the writer falls behind the queue fills and the fetchers wait, so
+    memory stays flat however large the submissions are.
 
-def collect_comments(subreddit_name, ids, destination_table):
+    Arguments:
+        config              - parsed config holding reddit credentials
+        subreddit_name      - String, used in progress output
+        ids                 - list of submission ids
+        destination_table   - table comments are written to
+        unsafe              - skip deduplication when writing
+        workers             - number of fetcher threads
+        queue_size          - comments held between fetchers and the writer
+        flush_rows          - comments written per flush
+        flush_seconds       - longest time comments wait to be written
+        job                 - checkpointed (subreddit, start, end) to mark
+                              submissions completed against
+        expand              - resolve collapsed comment branches in batches
+                              with a MoreCommentsExpander
+    """
+    pending = queue.Queue()
+    for s_id in ids:
+        pending.put(s_id)
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    budget = scheduler.RateBudget()
+
+    fetchers = list()
+    expander = None
+    if expand:
+        expander = MoreCommentsExpander(config, budget, results, stop, fetchers)
+    for n in range(max(workers, 1)):
+        t = threading.Thread(
+                target=_fetch_worker,
+                args=(config, budget, pending, results, stop, expander))
+        t.daemon = True
+        t.start()
+        fetchers.append(t)
+
+    threads = list(fetchers)
+    if expander is not None:
+        expander.start()
+        threads.append(expander)
+
+    full_comments = list()
+    completed_ids = list()
+    lost_ids = set()
+    failed_ids = list()
+    s_id = None
+    i = 0
+    started = time.time()
+    last_flush = started
     try:
-        full_comments = list()
-        i = 0
-        for s_id in ids:
-            i += 1
-            submission = praw.models.Submission(reddit, id=s_id)
-            submission.comments.replace_more(limit=0)
-            comments = submission.comments.list()
-            for comment in comments:
-                full_comments.append({
-                        'id': comment.id,
-                        'parent_id': comment.parent_id,
-                        'link_id': comment.link_id,
-                        'author': str(comment.author).replace('\x00', ''),
-                        'created': datetime.fromtimestamp(comment.created),
-                        'created_utc': datetime.fromtimestamp(comment.created_utc),
-                        'author_flair_text':comment.author_flair_text,
-                        'author_flair_css':comment.author_flair_css_class,
-                        'edited': bool(comment.edited),
-                        'body': comment.body.replace('\x00', '')
-                })
-
-            percentage = float(i) / float(len(ids)) * 100
-            msg = '\rProcessing {} of {} submissions in {}: {:00.5f}%'
-            sys.stdout.write(msg.format(i, len(ids), subreddit_name, percentage))
-            sys.stdout.flush()
-
-            if i % 1000 == 0:
-                ##############################################################
-                ### This stuff's all over the place, should probably go into a
-                ### intermediary function of it's own for convenience
-                ##############################################################
-                sys.stdout.write(' [...]')
-                sys.stdout.flush()
-                # get a fresh collection if ids alreadyin the database
-                time.sleep(5)
-                inserted_comments, skipped_comments, failed_comments = \
-                        _dump_to_database(full_comments, destination_table)
-                sys.stdout.write(' {} records written, {} skipped, {} failed; (last id {}) \n'.format(
-                        inserted_comments,
-                        skipped_comments,
-                        failed_comments,
-                        s_id.strip()))
+        while i < len(ids):
+            try:
+                kind, item = results.get(
+                        timeout=max(last_flush + flush_seconds - time.time(), 0.1))
+            except queue.Empty:
+                kind = None
+                if not any(t.is_alive() for t in threads) and results.empty():
+                    break
+
+            if kind == 'comment':
+                full_comments.append(item)
+            elif kind == 'done':
+                s_id = item
+                completed_ids.append(item)
+                i += 1
+                percentage = float(i) / float(len(ids)) * 100
+                rate = i / max(time.time() - started, 0.001)
+                msg = '\rProcessing {} of {} submissions in {}: {:00.5f}% ({:.2f} submissions/s, {})'
+                sys.stdout.write(msg.format(i, len(ids), subreddit_name, percentage,
+                        rate, budget.describe()))
                 sys.stdout.flush()
+            elif kind == 'failed':
+                failed_ids.append(item)
+                i += 1
+
+            if len(full_comments) >= flush_rows or \
+                    (len(full_comments) > 0 and time.time() - last_flush >= flush_seconds):
+                _flush(full_comments, destination_table, unsafe, s_id, job,
+                        completed_ids, lost_ids)
                 # Reset our comment list
                 full_comments = list()
+                completed_ids = list()
+                last_flush = time.time()
 
-        sys.stdout.write(' [...]')
-        sys.stdout.flush()
-        # get a fresh collection if ids already in the database
-        time.sleep(5)
-        inserted_comments, skipped_comments, failed_comments = \
-                _dump_to_database(full_comments, destination_table)
-        sys.stdout.write(' {} records written, {} skipped, {} failed; (last id {}) \n'.format(
-                inserted_comments,
-                skipped_comments,
-                failed_comments,
-                s_id.strip()))
-        sys.stdout.flush()
+        stop.set()
+        _flush(full_comments, destination_table, unsafe, s_id, job,
+                completed_ids, lost_ids)
 
     except (KeyboardInterrupt, SystemExit):
-        sys.stdout.write(' [...]')
-        sys.stdout.flush()
-        # get a fresh collection if ids alreadyin the database
-        time.sleep(5)
-        inserted_comments, skipped_comments, failed_comments = \
-                _dump_to_database(full_comments, destination_table)
-        sys.stdout.write(' {} records written, {} skipped, {} failed; (last id {}) \n'.format(
-                inserted_comments,
-                skipped_comments,
-                failed_comments,
-                s_id.strip()))
-        sys.stdout.flush()
+        # Write what's already been fetched and no more
+        stop.set()
+        for n in range(results.qsize()):
+            try:
+                kind, item = results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'comment':
+                full_comments.append(item)
+            elif kind == 'done':
+                completed_ids.append(item)
+        _flush(full_comments, destination_table, unsafe, s_id, job,
+                completed_ids, lost_ids)
 
     except Exception as e:
         logger.exception(e)
 
+    finally:
+        stop.set()
+        if expander is not None:
+            logger.info('expanded collapsed comments with {} extra requests'.format(
+                    expander.requests))
+        if len(failed_ids) > 0 or len(lost_ids) > 0:
+            logger.warning('{} submissions could not be fetched and {} not written; '
+                    'rerun to retry them'.format(len(failed_ids), len(lost_ids)))
+
 if __name__ == '__main__':
 
     args = parse_args()
@@ -378,10 +548,7 @@ if __name__ == '__main__':
         sys.exit(0)
 
     logger.debug('instantiate reddit object')
-    reddit = praw.Reddit(
-            client_id = config['DEFAULT']['reddit_client_id'],
-            client_secret = config['DEFAULT']['reddit_client_secret'],
-            user_agent = config['DEFAULT']['reddit_user_agent'])
+    reddit = _instantiate_reddit(config)
 
     global conn
     conn = None
@@ -398,14 +565,52 @@ if __name__ == '__main__':
         start_epoch = get_epoch(start_date)
         end_epoch = get_epoch(end_date)
 
-        logger.debug('find genesis post')
-        origin = get_genesis_post(subreddit, start_epoch, end_epoch, start_date, end_date)
-
-        logger.debug('obtain submission ids within')
-        ids = get_submission_ids(subreddit, start_epoch, end_epoch, end_date)
-        logger.info('collected {} submissions within range'.format(len(ids)))
-
-        collect_comments(args.subreddit, ids, args.table)
+        job = (args.subreddit, start_date, end_date)
+        if args.restart:
+            logger.debug('discard checkpoint')
+            checkpoint.delete_job(conn, job)
+
+        ids = checkpoint.load_job(conn, job)
+        if ids is not None:
+            logger.info('resuming from checkpoint; {} submissions remaining'.format(
+                    len(ids)))
+        elif args.by_id:
+            logger.debug('walk submission ids within')
+            ids = get_submission_ids_by_range(config, job, args.subreddit,
+                    start_epoch, end_epoch, args.workers)
+            if ids is None:
+                sys.exit(1)
+            logger.info('collected {} submissions within range'.format(len(ids)))
+        else:
+            logger.debug('find genesis post')
+            origin = harvest.get_genesis_post(conn, subreddit)
+            if origin is not None and origin > start_epoch:
+                start_epoch = origin
+
+            logger.debug('obtain submission ids within')
+            ids = get_submission_ids(config, args.subreddit, start_epoch,
+                    end_epoch, args.workers)
+            if ids is None:
+                # Not checkpointed, so a rerun harvests the range again
+                logger.error('harvest incomplete; rerun to search the range again')
+                sys.exit(1)
+            logger.info('collected {} submissions within range'.format(len(ids)))
+            checkpoint.save_job(conn, job, ids)
+
+        if args.use_async:
+            import asyncio
+            import async_engine
+
+            # Hand the checkpointed ids to the asyncio engine's own connections
+            conn.close()
+            conn = None
+            asyncio.run(async_engine.run_backfill(config, args.subreddit, ids,
+                    args.table, args.unsafe, args.workers, args.flush_rows,
+                    int(args.flush_seconds * 1000), args.queue_size, job))
+        else:
+            collect_comments(config, args.subreddit, ids, args.table,
+                    args.unsafe, args.workers, args.queue_size, args.flush_rows,
+                    args.flush_seconds, job, args.expand)
 
     except (KeyboardInterrupt, SystemExit):
         logger.info('exiting')
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 #
-# Collect a subreddit comment stream and log to database.
+# Collect the comment stream of one or more subreddits and log to database.
+#
+# Subreddits are streamed together as a combined a+b+c listing over a single
+# reddit session and database connection; each comment is routed to the
+# table of the subreddit it was posted in. New submissions are followed over
+# the same session and logged to reddit_submissions unless --comments-only.
 #
 # Requirements are simple enough, just praw and psycopg2 for postgres access.
 #   $ pip install praw psycopg2
@@ -8,16 +13,20 @@
 
 
 import argparse
+import collections
 import configparser
 import datetime
 import logging
 import os
 import sys
-import time
 
 import praw
 import psycopg2
 
+import bulk_writer
+import harvest
+import scheduler
+
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger('main')
 
@@ -26,18 +35,61 @@ working_dir = os.path.dirname(working_dir)
 
 def parse_args():
     parser = argparse.ArgumentParser(
-            description='Collect a subreddit stream to database.')
-
-    parser.add_argument('-s', '--subreddit', action='store', required=True,
-            help='subreddit to stream')
+            description='Collect one or more subreddit streams to database.')
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-s', '--subreddit', action='store', nargs='+',
+            help='subreddits to stream')
+    source.add_argument('-f', '--file', action='store',
+            help='file listing subreddits to stream, one per line')
+    source.add_argument('-m', '--metatable', action='store_true',
+            help='stream every subreddit in the reddit_subreddits table')
     parser.add_argument('-t', '--table', action='store',
-            default='{subreddit}')
+            default='{subreddit}',
+            help='destination table; {subreddit} is replaced per subreddit')
+    parser.add_argument('-w', '--window', action='store', type=int,
+            default=100000,
+            help='number of recent comment ids remembered to skip duplicates; '
+                    'seeded evenly from the destination tables')
+    parser.add_argument('--batch-rows', action='store', type=int, default=500,
+            help='commit after this many comments')
+    parser.add_argument('--batch-ms', action='store', type=int, default=1000,
+            help='commit at least this often, in milliseconds')
+    parser.add_argument('--comments-only', action='store_true',
+            help="don't follow the submission stream into reddit_submissions")
+    parser.add_argument('--spool', action='store',
+            default=os.path.join(working_dir, 'subreddit_stream.spool'),
+            help='file holding comments while the database is unreachable; '
+                    'not used with --async')
+    parser.add_argument('--async', action='store_true', dest='use_async',
+            help='stream listings concurrently with asyncpraw and asyncpg')
     parser.add_argument('-d', '--debug', action='store_true')
 
     args = parser.parse_args()
-    args.table = args.table.format(subreddit=args.subreddit)
     return args
 
+def _read_subreddit_file(path):
+    """Read subreddit names from a file, skipping blank lines and # comments."""
+    subreddits = list()
+    with open(path, 'r') as fin:
+        for line in fin:
+            line = line.split('#')[0].strip()
+            if len(line) > 0:
+                subreddits.append(line)
+    return subreddits
+
+def _get_metatable_subreddits():
+    """Get the subreddits listed in the reddit_subreddits metatable."""
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT subreddit FROM reddit_subreddits;')
+        return [row[0] for row in cursor.fetchall()]
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
 def parse_config():
     config = configparser.ConfigParser()
     config.read_file(open(os.path.join(working_dir, '../config.conf')))
@@ -97,102 +149,124 @@ def _get_last_n_ids(table, n):
 
     except Exception as e:
         logger.exception(e)
+        # Leave the connection usable for the tables seeded after this one
+        conn.rollback()
 
     finally:
         if cursor is not None:
             cursor.close()
 
 
-def _save_comment(subreddit, comment):
-    """Save a comment to the database.
+class RecentIds(object):
+    """A fixed-capacity window of the most recently seen ids.
 
-    Arguments:
-        subreddit   - String of the subreddit USED IN CRAFTING OUR INSERT!
-        comment     - A dictionary structure representing our table into which
-                      we save the comment.
+    Membership, insertion and eviction of the oldest id are all constant
+    time, so the window can hold hundreds of thousands of ids.
 
-    Note:
-    This function is NOT AT ALL SAFE for public use.
+    Arguments:
+        capacity    - most ids held; the oldest are evicted beyond that
     """
 
-    cursor = None
-    try:
-        cursor = conn.cursor()
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._ids = collections.OrderedDict()
 
-        sql = list()
-        sql = '''
-                INSERT INTO {subreddit} (
-                    id, parent_id, link_id, author, created, created_utc,
-                    author_flair_text, author_flair_css, edited, body)
-                VALUES (%(id)s, %(parent_id)s, %(link_id)s, %(author)s, %(created)s,
-                    %(created_utc)s, %(author_flair_text)s, %(author_flair_css)s,
-                    %(edited)s, %(body)s);
-        '''.format(subreddit=subreddit)
-        try:
-            cursor.execute(sql, comment)
-        except ValueError as e:
-            logger.exception(e)
-            logger.error('the comment is as follows\n')
-            logger.error(comment)
-        except Exception as e:
-            logger.exception(e)
+    def __contains__(self, id):
+        return id in self._ids
 
-        conn.commit()
-        return True
+    def __len__(self):
+        return len(self._ids)
 
-    except Exception as e:
-        logger.exception(e)
+    def add(self, id):
+        """Add an id; returns False if it was already in the window."""
+        if id in self._ids:
+            return False
+        self._ids[id] = None
+        while len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+        return True
 
-    finally:
-        if cursor is not None:
-            cursor.close()
+def collect_stream(tables, subreddit, ids, budget, writer, submission_ids=None):
+    """Follow a combined comment stream, saving new comments.
 
+    Every comment is routed to the table of the subreddit it was posted in.
+    Given submission_ids the submission stream is followed as well, over the
+    same session; both streams are polled in turn, each yielding whatever is
+    new before handing over to the other, and submissions are written to
+    reddit_submissions through the same writer.
 
-def collect_stream(subreddit_name, subreddit, ids):
+    Arguments:
+        tables          - dictionary mapping lower case subreddit names to tables
+        subreddit       - PRAW object for the combined a+b+c subreddit
+        ids             - RecentIds of comments already logged
+        budget          - scheduler.RateBudget
+        writer          - bulk_writer.BatchWriter group-committing the comments
+        submission_ids  - RecentIds of submissions already logged, or None to
+                          leave submissions alone
+
+    The budget tracks the rate limit headers of the stream's requests for
+    progress output, and paces reconnects after a failure with a jittered
+    exponential backoff that resets once the stream delivers again.
+    """
 
+    attempt = 0
+    i = 0
+    n_submissions = 0
     while True:
         try:
-            i = 0
             skipped = 0
-            for comment in subreddit.stream.comments(pause_after=-1):
-                if comment is None:
-                    continue
-                if comment.id in ids:
-                    skipped += 1
+            comments = subreddit.stream.comments(pause_after=-1)
+            submissions = None
+            if submission_ids is not None:
+                submissions = subreddit.stream.submissions(pause_after=-1)
+
+            while True:
+                for comment in comments:
+                    attempt = 0
+                    budget.update(subreddit._reddit)
+                    if comment is None:
+                        break
+                    if not ids.add(comment.id):
+                        skipped += 1
+                        continue
+                    if skipped > 0:
+                        logger.info('skipped {} comments; already logged'.format(skipped))
+                        skipped = 0
+
+                    table = tables.get(str(comment.subreddit).lower())
+                    if table is None:
+                        logger.error('no table for /r/{} comment {}'.format(
+                                comment.subreddit, comment.id))
+                        continue
+
+                    writer.add(table, bulk_writer.COMMENT_COLUMNS,
+                            harvest.comment_record(comment))
+                    i += 1
+                    if i % 10 == 0:
+                        dt = datetime.datetime.now()
+                        msg = '\r{dt} logged {n} comments and {m} submissions from {s} subreddits | {db} | {api}'.format(
+                                dt = str(dt), n = i, m = n_submissions,
+                                s = len(tables), db = writer.describe(),
+                                api = budget.describe())
+                        sys.stdout.write(msg)
+
+                if submissions is None:
                     continue
-                if skipped > 0:
-                    logger.info('skipped {} comments; already logged'.format(skipped))
-                    lds = ids[skipped:]
-                    skipped = 0
-                else:
-                    if len(ids) > 0:
-                        ids.pop(0)
-                    ids.append(comment.id)
-
-                comment_dict = {
-                        'id': comment.id,
-                        'parent_id': comment.parent_id,
-                        'link_id': comment.link_id,
-                        'author': str(comment.author).replace('\x00', ''),
-                        'created': datetime.datetime.fromtimestamp(comment.created),
-                        'created_utc': datetime.datetime.fromtimestamp(comment.created_utc),
-                        'author_flair_text':comment.author_flair_text,
-                        'author_flair_css':comment.author_flair_css_class,
-                        'edited': bool(comment.edited),
-                        'body': comment.body.replace('\x00', '')
-                }
-                _save_comment(
-                        subreddit_name,
-                        comment_dict)
-                i += 1
-                if i % 10 == 0:
-                    dt = datetime.datetime.now()
-                    msg = '\r{dt} logged {n} comments from {subreddit}'.format(
-                            dt = str(dt), n = i, subreddit = args.subreddit)
-                    sys.stdout.write(msg)
+                for submission in submissions:
+                    budget.update(subreddit._reddit)
+                    if submission is None:
+                        break
+                    if not submission_ids.add(submission.id):
+                        continue
+                    writer.add('reddit_submissions', bulk_writer.SUBMISSION_COLUMNS,
+                            harvest.submission_record(submission))
+                    n_submissions += 1
+
         except Exception as e:
             logger.exception(e)
-            time.sleep(15)
+            attempt += 1
+            delay = budget.backoff(attempt)
+            logger.info('reconnecting to stream after {:.1f}s'.format(delay))
         finally:
             pass
 
@@ -209,34 +283,82 @@ if __name__ == '__main__':
     db_user = config['DEFAULT']['db_user']
     db_pass = config['DEFAULT']['db_pass']
 
-    if not input('\nLog /r/{subreddit} to {table}? [y/N]'.format(
-            subreddit=args.subreddit, table=args.table)).lower() == 'y':
-        sys.exit(0)
-
-    logger.debug('instantiate reddit object')
-    reddit = praw.Reddit(
-            client_id = config['DEFAULT']['reddit_client_id'],
-            client_secret = config['DEFAULT']['reddit_client_secret'],
-            user_agent = config['DEFAULT']['reddit_user_agent'])
-
     global conn
     conn = None
+    writer = None
     try:
         logger.debug('connect to database')
         conn = _connect_to_db(db_host, db_name, db_user, db_pass)
         if conn is None:
             sys.exit(1)
 
+        if args.file is not None:
+            subreddits = _read_subreddit_file(args.file)
+        elif args.metatable:
+            subreddits = _get_metatable_subreddits()
+        else:
+            subreddits = args.subreddit
+        if len(subreddits) == 0:
+            logger.error('no subreddits to stream')
+            sys.exit(1)
 
-        # Get the last n comment ids so we don't try logging them a second time
+        # One connection and one session serve every subreddit; comments are
+        #   routed to their table by the subreddit they're posted in.
+        tables = dict()
+        for name in subreddits:
+            tables[name.lower()] = args.table.format(subreddit=name)
+
+        for name in subreddits:
+            print('/r/{} -> {}'.format(name, tables[name.lower()]))
+        if not input('\nLog {n} subreddits to the tables above? [y/N]'.format(
+                n=len(tables))).lower() == 'y':
+            sys.exit(0)
+
+        # Get the last n comment ids so we don't try logging them a second time.
+        #   The window is shared out among the tables so no table's ids evict
+        #   another's, and no more than the window is read at startup.
         logger.debug('get last comments from database')
-        ids = _get_last_n_ids(args.table, 500)
+        ids = RecentIds(args.window)
+        destinations = sorted(set(tables.values()))
+        per_table = max(args.window // len(destinations), 1)
+        for table in destinations:
+            # Oldest first so the newest ids are the last to be evicted
+            for id in reversed(_get_last_n_ids(table, per_table) or list()):
+                ids.add(id)
+
+        submission_ids = None
+        if not args.comments_only:
+            logger.debug('get last submissions from database')
+            submission_ids = RecentIds(args.window)
+            for id in reversed(_get_last_n_ids('reddit_submissions', args.window) or list()):
+                submission_ids.add(id)
+
+        if args.use_async:
+            import asyncio
+            import async_engine
+
+            logger.debug('stream on the asyncio engine')
+            asyncio.run(async_engine.run_stream(config, subreddits, tables, ids,
+                    args.batch_rows, args.batch_ms, submission_ids))
+            sys.exit(0)
+
+        logger.debug('instantiate reddit object')
+        reddit = praw.Reddit(
+                client_id = config['DEFAULT']['reddit_client_id'],
+                client_secret = config['DEFAULT']['reddit_client_secret'],
+                user_agent = config['DEFAULT']['reddit_user_agent'])
 
         logger.debug('instantiate subreddit object')
-        subreddit = reddit.subreddit(args.subreddit)
+        subreddit = reddit.subreddit('+'.join(subreddits))
 
         logger.debug('collect stream')
-        collect_stream(args.subreddit, subreddit, ids)
+        # Comments go to the spool while the database is down and are
+        #   replayed once a new connection is made.
+        writer = bulk_writer.BatchWriter(conn, args.batch_rows, args.batch_ms,
+                spool=bulk_writer.Spool(args.spool),
+                connect=lambda: _connect_to_db(db_host, db_name, db_user, db_pass))
+        collect_stream(tables, subreddit, ids, scheduler.RateBudget(), writer,
+                submission_ids)
 
     except (KeyboardInterrupt, SystemExit):
         logger.info('exiting')
@@ -245,6 +367,9 @@ if __name__ == '__main__':
         logger.exception(e)
 
     finally:
+        if writer is not None:
+            writer.close()
+            conn = writer.conn
         if not conn is None:
             conn.close()
 
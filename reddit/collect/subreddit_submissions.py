@@ -8,15 +8,18 @@
 
 import argparse
 import configparser
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 import os
 import sys
-import time
 
 import praw
 import psycopg2
 
+import bulk_writer
+import harvest
+import scheduler
+
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger('main')
 
@@ -56,6 +59,12 @@ def parse_args():
             help='subreddit to collect')
     parser.add_argument('-p', '--period', nargs=2, action='store',
             required=True, help='start and end date range formatted yyyymmddhhmmss')
+    parser.add_argument('-w', '--workers', action='store', type=int, default=1,
+            help='number of threads harvesting submissions concurrently')
+    parser.add_argument('--batch-rows', action='store', type=int, default=1000,
+            help='commit after this many submissions')
+    parser.add_argument('--batch-ms', action='store', type=int, default=10000,
+            help='commit at least this often, in milliseconds')
     parser.add_argument('-d', '--debug', action='store_true')
 
     args = parser.parse_args()
@@ -80,148 +89,36 @@ def parse_config():
 def get_epoch(dt):
     return (dt - epoch).total_seconds()
 
-def search_subreddit(subreddit, start_epoch, end_epoch):
-    """Return a list of submissions between start and end epoch.
-
-    Arguments:
-        subreddit   - praw subreddit object
-        start_epoch - float
-        end_epoch   - float
-    """
-
-    query = 'timestamp:{start_epoch}..{end_epoch}'.format(
-            start_epoch=int(start_epoch), end_epoch=int(end_epoch))
-    submissions = subreddit.search(
-            query,
-            sort='new',
-            syntax='cloudsearch')
-
-    return list(submissions)
+def _instantiate_reddit(config):
+    return praw.Reddit(
+            client_id = config['DEFAULT']['reddit_client_id'],
+            client_secret = config['DEFAULT']['reddit_client_secret'],
+            user_agent = config['DEFAULT']['reddit_user_agent'])
 
-def get_genesis_post(subreddit, start_epoch, end_epoch, start_date, end_date):
-    '''Walk subscriptions backwards; find the subreddit's first post.
+def collect_submissions(config, subreddit_name, start_epoch, end_epoch, writer,
+        workers=1):
+    """Collect all submissions in a range, writing them as they're found.
 
-    The origin submission for a subreddit would be the very first, still
-    accessible, submission. Alternatively, this function returns the first
-    submission within the specified date range.
+    See harvest.harvest_submissions; the date range is sharded and searched
+    by workers threads sharing one request budget. Each page is converted to
+    records straight away and handed to the writer, so PRAW objects don't
+    pile up and a crash only loses the batch not yet committed.
 
     Arguments:
-        subreddit   - PRAW object
-        start_date  - datetime
-        end_date    - datetime
-    '''
-    origin = None
-
-    # Find the origin year
-    while True:
-        start_epoch = get_epoch(start_date)
-        end_epoch = get_epoch(end_date)
-        submissions = search_subreddit(subreddit, start_epoch, end_epoch)
-        if len(submissions) == 0:
-            end_date = end_date.replace(year=end_date.year + 1)
-            break
-        sys.stdout.write('\rsearching genesis post for {} in {}'.format(
-                subreddit, end_date))
-        sys.stdout.flush()
-        end_date = end_date.replace(year=end_date.year - 1)
-
-    # Reset end_epoch to last year
-    end_epoch = get_epoch(end_date)
-
-    # Now iterate months until we find the origin month
-    while True:
-        start_epoch = get_epoch(start_date)
-        end_epoch = get_epoch(end_date)
-        submissions = search_subreddit(subreddit, start_epoch, end_epoch)
-        last_month = end_date
-        if len(submissions) == 0:
-            end_date = end_date
-            break
-        origin = submissions[-1].created
-        sys.stdout.write('\rsearching genesis post for {} in {}'.format(
-                subreddit, end_date))
-        sys.stdout.flush()
-        end_date = end_date.replace(day=end_date.day - end_date.day + 1)
-        end_date += timedelta(days=-1)
-
-    sys.stdout.write('\rfound {} origin submission at {}; epoch is {}\n'.format(
-            subreddit, end_date, origin))
-    sys.stdout.flush()
-    return origin
-
-def get_submission_objects(subreddit, start_epoch, end_epoch, end_date):
-    """Collect all submissions in a range; return a list of submission objs."""
-    i = 0
-    ids = list()
-
-    end_epoch_saved =  None
-    while True:
-
-        # We request all submissions within our start and end date range
-        submissions = search_subreddit(subreddit, start_epoch, end_epoch)
-        if len(submissions) == 0:
-            sys.stdout.write('\n')
-            sys.stdout.flush()
-            break
-
-        # A limited number of the newest submissions are returned
-        #   so get the end_epoch of the last received submission and update our
-        #   date range.
-        end_epoch = submissions[-1].created - 1
-
-        if i == 0:
-            end_epoch_saved = end_epoch
-        # Note: are we working with created, rather than created_utc? We might
-        #   want to fix that sometime, but it works for now so who cares.
-        end_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_epoch))
-
-        # How many we've done / how manty to do
-        now = get_epoch(datetime.now())
-        percentage = (end_epoch_saved - end_epoch) / (end_epoch_saved - start_epoch) * 100
-        sys.stdout.write(
-                '\rharvest {} submission ids {:00.2f}% complete | '.format(subreddit, percentage) + \
-                'date: {} end_epoc: {}'.format(end_date, end_epoch))
-        sys.stdout.flush()
-
-        for s in submissions:
-            ids.append(s)
-
-        i += 1
-
-    return ids
-
-def _get_last_n_submission_ids(table, n):
-    """Get the last n submission ids from the database.
-
-    Note:
-    This function is in no way safe for public use!
-    """
-
-    cursor = None
-    try:
-        cursor = conn.cursor()
+        writer  - bulk_writer.BatchWriter committing the submissions
 
-        sql = '''
-            SELECT id
-            FROM reddit_submissions
-            ORDER BY created_utc DESC
-            LIMIT {n};
-        '''.format(table = table, n = n)
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-
-        ids = dict()
-        for row in rows:
-            ids[row[0]] = None
-
-        return ids
-
-    except Exception as e:
-        logger.exception(e)
+    Returns the number of submissions found, or None when windows of the
+    range could not be searched and the harvest is incomplete.
+    """
+    def on_page(submissions):
+        for submission in submissions:
+            writer.add('reddit_submissions', bulk_writer.SUBMISSION_COLUMNS,
+                    harvest.submission_record(submission))
 
-    finally:
-        if cursor is not None:
-            cursor.close()
+    ids = harvest.harvest_submissions(
+            lambda: _instantiate_reddit(config).subreddit(subreddit_name),
+            start_epoch, end_epoch, workers, scheduler.RateBudget(), on_page)
+    return len(ids) if ids is not None else None
 
 if __name__ == '__main__':
 
@@ -237,13 +134,11 @@ if __name__ == '__main__':
     db_pass = config['DEFAULT']['db_pass']
 
     logger.debug('instantiate reddit object')
-    reddit = praw.Reddit(
-            client_id = config['DEFAULT']['reddit_client_id'],
-            client_secret = config['DEFAULT']['reddit_client_secret'],
-            user_agent = config['DEFAULT']['reddit_user_agent'])
+    reddit = _instantiate_reddit(config)
 
     global conn
     conn = None
+    incomplete = False
     try:
         logger.debug('connect to database')
         conn = _connect_to_db(db_host, db_name, db_user, db_pass)
@@ -258,51 +153,25 @@ if __name__ == '__main__':
         end_epoch = get_epoch(end_date)
 
         logger.debug('find genesis post')
-        origin = get_genesis_post(subreddit, start_epoch, end_epoch, start_date, end_date)
-
-        logger.debug('obtain submission ids within')
-        submissions = get_submission_objects(subreddit, start_epoch, end_epoch, end_date)
-        logger.info('collected {} submissions within range'.format(len(submissions)))
-
-        cursor = conn.cursor()
-
-        # TODO: get_last_n_submission_ids and avoid inserting duplicates
-
-        for submission in submissions:
-            sql = '''
-                    INSERT INTO reddit_submissions (
-                        id, subreddit, author, author_flair_text, author_flair_css,
-                        created, created_utc, domain, downs, ups, score, num_comments, name,
-                        permalink, url, selftext, title)
-                    VALUES (%(id)s, %(subreddit)s, %(author)s, %(author_flair_text)s,
-                        %(author_flair_css)s, %(created)s, %(created_utc)s, %(domain)s,
-                        %(downs)s, %(ups)s, %(score)s, %(num_comments)s, %(name)s,
-                        %(permalink)s, %(url)s, %(selftext)s, %(title)s);
-            '''
-            try:
-                cursor.execute(sql,
-                        {'id': submission.id,
-                        'subreddit':submission.subreddit.display_name,
-                        'author':str(submission.author).replace('\x00', ''),
-                        'author_flair_text':submission.author_flair_text,
-                        'author_flair_css':submission.author_flair_css_class,
-                        'created':datetime.fromtimestamp(submission.created),
-                        'created_utc':datetime.fromtimestamp(submission.created_utc),
-                        'domain':submission.domain,
-                        'downs':submission.downs,
-                        'ups':submission.ups,
-                        'score':submission.score,
-                        'num_comments':submission.num_comments,
-                        'name':submission.name,
-                        'permalink':submission.permalink,
-                        'url':submission.url,
-                        'selftext':submission.selftext.replace('\x00', ''),
-                        'title':submission.title}
-                 )
-            except Exception as e:
-                logger.exception(e)
-                logger.error(submission)
-        conn.commit()
+        origin = harvest.get_genesis_post(conn, subreddit)
+        if origin is not None and origin > start_epoch:
+            start_epoch = origin
+
+        logger.debug('harvest and write submissions within')
+        writer = bulk_writer.BatchWriter(conn, args.batch_rows, args.batch_ms)
+        try:
+            n = collect_submissions(config, args.subreddit, start_epoch,
+                    end_epoch, writer, args.workers)
+        finally:
+            writer.close()
+        if n is None:
+            incomplete = True
+            logger.error('harvest incomplete; what was found is written, rerun '
+                    'to search the range again')
+        else:
+            logger.info('collected {} submissions within range'.format(n))
+        logger.info('{} submissions written, {} skipped, {} failed'.format(
+                writer.inserted, writer.skipped, writer.failed))
 
     except (KeyboardInterrupt, SystemExit):
         logger.info('exiting')
@@ -314,4 +183,4 @@ if __name__ == '__main__':
         if not conn is None:
             conn.close()
 
-    sys.exit(0)
+    sys.exit(1 if incomplete else 0)
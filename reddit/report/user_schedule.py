@@ -21,6 +21,14 @@ logger = logging.getLogger('main')
 working_dir = os.path.realpath(__file__)
 working_dir = os.path.dirname(working_dir)
 
+# A user's comments and submissions together, to query in place of a table
+USER_ACTIVITY = '''(
+        SELECT id, author, subreddit, created_utc, false AS submission
+        FROM user_comments
+        UNION ALL
+        SELECT id, author, subreddit, created_utc, true AS submission
+        FROM reddit_submissions)'''
+
 def parse_args():
     parser = argparse.ArgumentParser(
             description='Generate a user post schedule showing when they use Reddit.')
@@ -63,20 +71,21 @@ def _connect_to_db(dh_host, db_name, db_user, db_user_pass):
 def _user_weekly(user):
     """Query tables to get a user posting schedule grouped by day and hour.
 
-    The user_comments table, then subreddit tables are queried in succession,
-    grouped by day of week (Mon through Sun) and hour of day to produce a
-    user posting schedule.
+    The user_comments and reddit_submissions tables, then subreddit tables
+    are queried in succession, grouped by day of week (Mon through Sun) and
+    hour of day to produce a user posting schedule.
     """
     # TODO: Add an argument to specify additional tables, default ALL
     #   which could pull from a "metatable" in postgres listing tables we've
     #   scraped.
 
-    # This query only works on the user_comments table
+    # This query only works on the user history tables; their comments and
+    #   submissions are counted together in one pass.
     with open(os.path.join(working_dir, 'sql/query/user_weekly.sql'), 'r') as fin:
         sql = fin.read()
 
-    logger.info('querying {}'.format('user_comments'))
-    sql = sql.format(user = user, table='user_comments')
+    logger.info('querying {}'.format('user_comments and reddit_submissions'))
+    sql = sql.format(user = user, table=USER_ACTIVITY)
     cursor = conn.cursor()
     cursor.execute(sql)
     rows = cursor.fetchall()
@@ -165,12 +174,13 @@ def _get_user_history(user):
     cursor = conn.cursor()
     cursor.execute('''
             select subreddit,
-                count(id) as post_count
-            from user_comments
+                count(id) as post_count,
+                count(id) filter (where submission) as submission_count
+            from {activity} activity
             where lower(author) = %(user)s
             group by subreddit
             order by post_count desc;
-    ''', {'user':user})
+    '''.format(activity=USER_ACTIVITY), {'user':user})
     rows = cursor.fetchall()
     return rows
 
@@ -248,8 +258,10 @@ if __name__ == '__main__':
         #print(_get_oldest_and_newest_comment(args.user))
 
         count = _user_history_count(rows)
+        submissions = sum(row[2] for row in rows)
         print('\n')
-        print('/u/{u} history has {c} posts'.format(u = args.user, c = count))
+        print('/u/{u} history has {c} posts ({s} submissions)'.format(
+                u = args.user, c = count, s = submissions))
         longest_subreddit = 0
         for row in rows:
             if len(row[0]) > longest_subreddit:
@@ -259,6 +271,8 @@ if __name__ == '__main__':
             subreddit += ' ' * (longest_subreddit - len(row[0]))
             subreddit += ' {: >5} '.format(row[1])
             subreddit += '({:#5.1%})'.format((row[1] / count))
+            if row[2] > 0:
+                subreddit += ' {: >4} submissions'.format(row[2])
 
             print(subreddit)
         print('\n')
@@ -0,0 +1,39 @@
+-- Tweets collected by user_timeline.py --db, with their hashtags and urls in
+-- side tables keyed by tweet id
+CREATE TABLE tweets (
+    id bigint NOT NULL PRIMARY KEY,
+    author character varying(50),
+    created_utc timestamp without time zone,
+    lang character varying(10),
+    favorite_count integer,
+    retweet_count integer,
+    retweeted_author character varying(50),
+    in_reply_to_status_id bigint,
+    text character varying(2000)
+);
+CREATE INDEX tweets_author_idx ON tweets (lower(author), created_utc);
+CREATE TABLE tweet_hashtags (
+    tweet_id bigint NOT NULL,
+    hashtag character varying(280) NOT NULL,
+    PRIMARY KEY (tweet_id, hashtag)
+);
+CREATE TABLE tweet_urls (
+    tweet_id bigint NOT NULL,
+    url character varying(2000) NOT NULL,
+    PRIMARY KEY (tweet_id, url)
+);
+-- The newest tweet id collected from each account's timeline, saved once a
+-- run has paged down to the previous one; the next run passes it as since_id.
+CREATE TABLE twitter_timelines (
+    screen_name character varying(50) NOT NULL PRIMARY KEY,
+    since_id bigint NOT NULL,
+    collected_at timestamp without time zone DEFAULT now()
+);
+-- Rows tweet_writer.py could not load, kept for inspection and replay
+CREATE TABLE twitter_quarantine (
+    table_name character varying(50),
+    id bigint,
+    record text,
+    error text,
+    quarantined_at timestamp without time zone DEFAULT now()
+);
@@ -0,0 +1,170 @@
+#
+# Bulk write tweets to the database through COPY.
+#
+# A batch of tweets is streamed with COPY ... FROM STDIN into temporary
+# staging tables shaped like tweets, tweet_hashtags and tweet_urls, then
+# merged into them with one INSERT ... SELECT each, skipping tweets already
+# stored. A row postgres refuses is isolated by splitting the batch and is
+# quarantined to the twitter_quarantine table rather than failing the whole
+# batch. See sql/schema/tweets_table.sql.
+#
+# The same approach as reddit/collect/bulk_writer.py, which the twitter
+# scripts can't import.
+#
+
+import io
+import json
+import logging
+
+logger = logging.getLogger('main')
+
+TWEET_COLUMNS = (
+        'id', 'author', 'created_utc', 'lang', 'favorite_count',
+        'retweet_count', 'retweeted_author', 'in_reply_to_status_id', 'text')
+
+# Side tables: name, columns, the tweet record key listing their values
+SIDE_TABLES = (
+        ('tweet_hashtags', ('tweet_id', 'hashtag'), 'hashtags'),
+        ('tweet_urls', ('tweet_id', 'url'), 'urls'))
+
+QUARANTINE_TABLE = 'twitter_quarantine'
+
+def _copy_value(value):
+    """Format a single value for the COPY text format."""
+    if value is None:
+        return '\\N'
+    value = str(value)
+    return value.replace('\\', '\\\\') \
+            .replace('\t', '\\t') \
+            .replace('\n', '\\n') \
+            .replace('\r', '\\r')
+
+def _copy_rows(cursor, table, columns, rows):
+    """COPY rows into table, splitting the batch to isolate rejected rows.
+
+    Rows are sequences of values in column order. Each attempt runs under a
+    savepoint so a rejected COPY leaves the rows already staged untouched.
+
+    Returns a list of (row, error) tuples for rows that could not be copied.
+    """
+    if len(rows) == 0:
+        return list()
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(_copy_value(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.execute('SAVEPOINT tweet_copy;')
+    try:
+        cursor.copy_expert('COPY {table} ({columns}) FROM STDIN'.format(
+                table=table, columns=', '.join(columns)), buf)
+        cursor.execute('RELEASE SAVEPOINT tweet_copy;')
+        return list()
+    except Exception as e:
+        cursor.execute('ROLLBACK TO SAVEPOINT tweet_copy;')
+        cursor.execute('RELEASE SAVEPOINT tweet_copy;')
+        if len(rows) == 1:
+            return [(rows[0], str(e).strip())]
+
+    middle = len(rows) // 2
+    return _copy_rows(cursor, table, columns, rows[:middle]) + \
+            _copy_rows(cursor, table, columns, rows[middle:])
+
+def _quarantine(cursor, table, columns, rejected):
+    """Record rejected rows so they can be inspected and replayed later."""
+    sql = '''
+        INSERT INTO {quarantine} (table_name, id, record, error)
+        VALUES (%(table_name)s, %(id)s, %(record)s, %(error)s);
+    '''.format(quarantine=QUARANTINE_TABLE)
+    for row, error in rejected:
+        logger.error('quarantined {} row {}: {}'.format(table, row[0], error))
+        cursor.execute('SAVEPOINT tweet_quarantine;')
+        try:
+            cursor.execute(sql, {
+                    'table_name': table,
+                    'id': row[0],
+                    'record': json.dumps(dict(zip(columns, row)), default=str),
+                    'error': error})
+            cursor.execute('RELEASE SAVEPOINT tweet_quarantine;')
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT tweet_quarantine;')
+            logger.exception(e)
+            logger.error(row)
+
+def _stage(cursor, table, columns, rows):
+    """Load rows into a session-local staging table shaped like table.
+
+    Returns the staging table's name and the rows it rejected, which are
+    quarantined.
+    """
+    staging = '_staging_{table}'.format(table=table)
+    cursor.execute('''
+        CREATE TEMPORARY TABLE IF NOT EXISTS {staging}
+            (LIKE {table} INCLUDING DEFAULTS)
+            ON COMMIT DELETE ROWS;
+    '''.format(staging=staging, table=table))
+    rejected = _copy_rows(cursor, staging, columns, rows)
+    if len(rejected) > 0:
+        _quarantine(cursor, table, columns, rejected)
+    return staging, rejected
+
+def write_tweets(conn, tweets):
+    """Bulk write a batch of tweets and their hashtags and urls; commit.
+
+    Hashtags and urls of a tweet that was rejected are left out with it.
+
+    Arguments:
+        conn    - psycopg2 connection
+        tweets  - list of dictionaries keyed by TWEET_COLUMNS, plus hashtags
+                  and urls lists
+
+    Returns inserted_tweets, skipped_tweets, failed_tweets
+    """
+    if len(tweets) == 0:
+        return 0, 0, 0
+
+    cursor = None
+    try:
+        cursor = conn.cursor()
+
+        staging, rejected = _stage(cursor, 'tweets', TWEET_COLUMNS,
+                [[t[c] for c in TWEET_COLUMNS] for t in tweets])
+        cursor.execute('''
+            INSERT INTO tweets ({columns})
+            SELECT DISTINCT ON (s.id) {staged_columns}
+            FROM {staging} s
+            ON CONFLICT (id) DO NOTHING;
+        '''.format(
+                columns=', '.join(TWEET_COLUMNS),
+                staged_columns=', '.join('s.' + c for c in TWEET_COLUMNS),
+                staging=staging))
+        inserted = cursor.rowcount
+
+        rejected_ids = set(row[0] for row, error in rejected)
+        for table, columns, key in SIDE_TABLES:
+            rows = set()
+            for t in tweets:
+                if t['id'] in rejected_ids:
+                    continue
+                for value in t[key]:
+                    rows.add((t['id'], value))
+            if len(rows) == 0:
+                continue
+            staging = _stage(cursor, table, columns, list(rows))[0]
+            cursor.execute('''
+                INSERT INTO {table} ({columns})
+                SELECT {columns} FROM {staging}
+                ON CONFLICT DO NOTHING;
+            '''.format(table=table, columns=', '.join(columns), staging=staging))
+
+        conn.commit()
+        return inserted, len(tweets) - len(rejected) - inserted, len(rejected)
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        if cursor is not None:
+            cursor.close()
@@ -1,36 +1,273 @@
 #!/usr/bin/env python
 #
+# Collect twitter users' timelines to a CSV file or to the database.
+#
+# With --db tweets are bulk written through COPY into the tweets table, with
+# their hashtags and urls in side tables, so the same reports run over twitter
+# and reddit data. See sql/schema/tweets_table.sql.
+#
+# The newest tweet id collected from each account is saved, in the
+# twitter_timelines table with --db or in a state file next to the CSV
+# otherwise, and the next run asks only for tweets after it. New tweets are
+# appended, so refreshing a watched account costs a request or two.
+#
 
 import argparse
 import configparser
 import csv
 import datetime
+import json
 import logging
+import os
 import sys
 
+import psycopg2
 import tweepy
 
+import tweet_writer
+
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger('main')
 
+working_dir = os.path.realpath(__file__)
+working_dir = os.path.dirname(working_dir)
+
 def parse_args():
     parser = argparse.ArgumentParser(
-            description='Collect a users comment history.')
+            description='Collect the timelines of one or more twitter users.')
 
-    parser.add_argument('-u', '--user', action='store', required=True,
-            help='redditor to collect')
-    parser.add_argument('-o', '--output', action='store', default='./output.csv')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-u', '--user', action='store', nargs='+',
+            help='twitter users to collect')
+    source.add_argument('-f', '--file', action='store',
+            help='file listing twitter users to collect, one per line')
+    parser.add_argument('-o', '--output', action='store', default='./output.csv',
+            help='CSV file new tweets are appended to')
+    parser.add_argument('-s', '--state', action='store',
+            help='file saving the newest tweet id of each user; defaults to '
+                    'the output file name with .since appended')
+    parser.add_argument('--db', action='store_true',
+            help='write to the tweets table instead of a CSV file')
+    parser.add_argument('--batch-rows', action='store', type=int, default=1000,
+            help='tweets written to the database at a time')
+    parser.add_argument('--full', action='store_true',
+            help='ignore the saved tweet ids and collect whole timelines')
     parser.add_argument('-d', '--debug', action='store_true')
 
     args = parser.parse_args()
+    if args.state is None:
+        args.state = args.output + '.since'
     return args
 
 def parse_config():
     config = configparser.ConfigParser()
-    config.read_file(open('./config.conf'))
+    config.read_file(open(os.path.join(working_dir, 'config.conf')))
     return config
 
+def _connect_to_db(dh_host, db_name, db_user, db_user_pass):
+    conn = None
+    cursor = None
+
+    connstr = \
+            "host={db_host} " + \
+            "dbname='{db_name}' " + \
+            "user='{db_user}' " + \
+            "password='{db_user_pass}'"
+    connstr = connstr.format(
+                db_host=db_host,
+                db_name=db_name,
+                db_user=db_user,
+                db_user_pass=db_user_pass)
+    try:
+        conn = psycopg2.connect(connstr)
+
+    except Exception as e:
+        logger.exception(e)
+
+    return conn
+
+def _tweet_record(tweet):
+    """Convert a tweepy status into a dictionary keyed by column name."""
+    # There's a ton of other stuff available. Dump the full contents of a
+    #   tweet from the api using pprint.pprint(vars(tweet))
+    retweeted_author = None
+    retweeted_author_name = None
+    if hasattr(tweet, 'retweeted_status'):
+        retweeted_author = tweet.retweeted_status.author.screen_name
+        retweeted_author_name = tweet.retweeted_status.author.name
+
+    return {
+            'id': tweet.id,
+            'author': tweet.author.screen_name,
+            'created_utc': tweet.created_at.replace(tzinfo=None),
+            'lang': tweet.lang,
+            'favorite_count': tweet.favorite_count,
+            'retweet_count': tweet.retweet_count,
+            'retweeted_author': retweeted_author,
+            'retweeted_author_name': retweeted_author_name,
+            'in_reply_to_status_id': tweet.in_reply_to_status_id,
+            'text': tweet.text.replace('\x00', ''),
+            'hashtags': [h['text'] for h in tweet.entities['hashtags']],
+            'urls': [u['expanded_url'] for u in tweet.entities['urls']
+                    if u.get('expanded_url')]
+    }
+
+def _read_user_file(path):
+    """Read twitter user names from a file, skipping blank lines and # comments."""
+    users = list()
+    with open(path, 'r') as fin:
+        for line in fin:
+            line = line.split('#')[0].strip()
+            if len(line) > 0:
+                users.append(line)
+    return users
+
+def _read_state(path):
+    """Read the saved since ids, keyed by lower case user name, from a file."""
+    if not os.path.exists(path):
+        return dict()
+    with open(path, 'r') as fin:
+        return json.load(fin)
+
+def _write_state(path, state):
+    """Replace the state file, so an interrupted write never truncates it."""
+    with open(path + '.tmp', 'w') as fout:
+        json.dump(state, fout, indent=1, sort_keys=True)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(path + '.tmp', path)
+
+def _get_since_ids(users):
+    """Get the saved since ids of users from the twitter_timelines table.
+
+    Returns a dictionary mapping lower case user names to tweet ids; users
+    never collected are left out.
+    """
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT screen_name, since_id
+            FROM twitter_timelines
+            WHERE screen_name = ANY(%(users)s);
+        ''', {'users': [user.lower() for user in users]})
+        return dict(cursor.fetchall())
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _save_since_id(user, since_id):
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO twitter_timelines (screen_name, since_id)
+            VALUES (%(user)s, %(since_id)s)
+            ON CONFLICT (screen_name) DO UPDATE
+                SET since_id = EXCLUDED.since_id, collected_at = now();
+        ''', {'user': user.lower(), 'since_id': since_id})
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+
+def _csv_writer(csvfile):
+    """Return a DictWriter over csvfile, writing the header if it's empty."""
+    field_names = ['author.screen_name', 'created_at_utc', 'lang',
+        'favorite_count', 'retweet_count', 'retweet_status.author.name',
+        'hashtags', 'urls', 'text']
+    csv_writer = csv.DictWriter(
+            csvfile, delimiter=',',
+            quotechar='"',
+            quoting=csv.QUOTE_MINIMAL,
+            fieldnames=field_names)
+    if csvfile.tell() == 0:
+        csv_writer.writeheader()
+    return csv_writer
+
+def _write_csv(pages, csv_writer):
+    """Write pages of tweets to the CSV file; return the number written."""
+    written = 0
+    for page in pages:
+        for record in page:
+            csv_writer.writerow({
+                    'author.screen_name': record['author'],
+                    'created_at_utc': (record['created_utc'] - \
+                            datetime.datetime.utcfromtimestamp(0)).total_seconds(),
+                    'lang': record['lang'],
+                    'favorite_count': record['favorite_count'],
+                    'retweet_count': record['retweet_count'],
+                    'retweet_status.author.name': record['retweeted_author_name'],
+                    'hashtags': ' '.join(record['hashtags']),
+                    'urls': ' '.join(record['urls']),
+                    'text': record['text']})
+        written += len(page)
+    return written
+
+def _write_db(pages, batch_rows):
+    """Write pages of tweets to the database every batch_rows tweets.
+
+    Returns the number of tweets inserted; tweets already stored are skipped
+    and tweets postgres refuses are quarantined.
+    """
+    counts = [0, 0, 0]
+    batch = list()
+    for page in pages:
+        batch.extend(page)
+        if len(batch) >= batch_rows:
+            for n, count in enumerate(tweet_writer.write_tweets(conn, batch)):
+                counts[n] += count
+            batch = list()
+    for n, count in enumerate(tweet_writer.write_tweets(conn, batch)):
+        counts[n] += count
+    if counts[2] > 0:
+        logger.warning('{} tweets quarantined to {}'.format(
+                counts[2], tweet_writer.QUARANTINE_TABLE))
+    return counts[0]
+
+def _timeline_pages(api, user, since_id=None):
+    """Yield the user's timeline a page of tweet records at a time.
+
+    Only tweets newer than since_id are requested, if it's given.
+    """
+    kwargs = {'id': user, 'count': 200}
+    if since_id is not None:
+        kwargs['since_id'] = since_id
+    for page in tweepy.Cursor(api.user_timeline, **kwargs).pages():
+        yield [_tweet_record(tweet) for tweet in page]
+
+def _collect_timeline(api, user, since_id, write):
+    """Collect a user's tweets newer than since_id and hand them to write.
+
+    Arguments:
+        api         - tweepy API object
+        user        - twitter user name
+        since_id    - newest tweet id already collected, or None
+        write       - callable taking an iterable of pages of tweet records
+                      and returning the number of tweets written
+
+    Returns the number of tweets written and the newest tweet id seen, which
+    is since_id when the user hasn't tweeted since.
+    """
+    newest = {'id': since_id}
+
+    def pages():
+        for page in _timeline_pages(api, user, since_id):
+            for record in page:
+                if newest['id'] is None or record['id'] > newest['id']:
+                    newest['id'] = record['id']
+            yield page
+
+    written = write(pages())
+    return written, newest['id']
+
 if __name__ == '__main__':
     config = parse_config()
     twitter_consumer_key = config['DEFAULT']['twitter_consumer_key']
@@ -40,48 +277,82 @@ if __name__ == '__main__':
 
     args = parse_args()
 
+    if args.debug:
+        logger.level = logging.DEBUG
+
     auth = tweepy.OAuthHandler(twitter_consumer_key, twitter_consumer_secret)
     auth.set_access_token(access_token, access_secret)
 
-    api = tweepy.API(auth)
-    #public_tweets = api.user_timeline()
-
-    with open(args.output, 'w') as csvfile:
-        field_names = ['author.screen_name', 'created_at_utc', 'lang',
-            'favorite_count', 'retweet_count', 'retweet_status.author.name',
-            'hashtags', 'urls', 'text']
-        csv_writer = csv.DictWriter(
-                csvfile, delimiter=',',
-                quotechar='"',
-                quoting=csv.QUOTE_MINIMAL,
-                fieldnames=field_names)
-        csv_writer.writeheader()
+    # Refreshing hundreds of timelines can run into the rate limit; wait it
+    #   out rather than failing the remaining users.
+    api = tweepy.API(auth, wait_on_rate_limit=True)
+
+    global conn
+    conn = None
+    csvfile = None
+    failed = list()
+    try:
+        users = args.user
+        if args.file is not None:
+            users = _read_user_file(args.file)
+
+        if args.db:
+            db_host = config['DEFAULT']['db_host']
+            db_name = config['DEFAULT']['db_name']
+            db_user = config['DEFAULT']['db_user']
+            db_pass = config['DEFAULT']['db_pass']
+
+            logger.debug('connect to database')
+            conn = _connect_to_db(db_host, db_name, db_user, db_pass)
+            if conn is None:
+                sys.exit(1)
+            since_ids = _get_since_ids(users)
+            write = lambda pages: _write_db(pages, args.batch_rows)
+        else:
+            state = _read_state(args.state)
+            since_ids = state
+            csvfile = open(args.output, 'a')
+            csv_writer = _csv_writer(csvfile)
+            write = lambda pages: _write_csv(pages, csv_writer)
+
+        if args.full:
+            since_ids = dict()
 
-        # TODO: Clean up this awful super-nesting
-        for page in tweepy.Cursor(api.user_timeline, id=args.user).pages():
+        for user in users:
+            since_id = since_ids.get(user.lower())
+            try:
+                written, newest_id = _collect_timeline(api, user, since_id, write)
+            except Exception as e:
+                logger.error('could not collect {}: {}'.format(user, e))
+                failed.append(user)
+                continue
 
-            for tweet in page:
-                # There's a ton of other stuff available. Dump the full contents of a
-                #   tweet from the api using pprint.pprint(vars(tweet))
-                if tweet.retweeted:
-                    retweet_status_author_name = tweet.retweeted_status.author.name
+            # The saved id only moves once the whole gap down to the previous
+            #   one is written; an interrupted run asks for it all again.
+            if newest_id is not None and newest_id != since_id:
+                if args.db:
+                    _save_since_id(user, newest_id)
                 else:
-                    retweet_status_author_name = None
-                hashtags = []
-                for hashtag in tweet.entities['hashtags']:
-                    hashtags.append(hashtag['text'])
-                urls = []
-                for url in tweet.entities['urls']:
-                    urls.append(url['expanded_url'])
-                t = tweet.text.encode('utf-8')
-                csv_writer.writerow({
-                        'author.screen_name': tweet.author.screen_name,
-                        'created_at_utc': (tweet.created_at - \
-                                datetime.datetime.utcfromtimestamp(0)).total_seconds(),
-                        'lang': tweet.lang,
-                        'favorite_count': tweet.favorite_count,
-                        'retweet_count': tweet.retweet_count,
-                        'retweet_status.author.name': retweet_status_author_name,
-                        'hashtags': ' '.join(hashtags),
-                        'urls': ' '.join(urls),
-                        'text': tweet.text})
+                    csvfile.flush()
+                    os.fsync(csvfile.fileno())
+                    state[user.lower()] = newest_id
+                    _write_state(args.state, state)
+            logger.info('{}: {} new tweets'.format(user, written))
+
+        if len(failed) > 0:
+            logger.error('{} of {} users failed: {}'.format(
+                    len(failed), len(users), ' '.join(failed)))
+
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('exiting')
+
+    except Exception as e:
+        logger.exception(e)
+
+    finally:
+        if csvfile is not None:
+            csvfile.close()
+        if not conn is None:
+            conn.close()
+
+    sys.exit(1 if len(failed) > 0 else 0)